@@ -0,0 +1,351 @@
+"""Benchmarks for the plone.scale scaling pipeline.
+
+All input images are generated, so this runs offline::
+
+    python benchmarks/bench_scaling.py
+    python benchmarks/bench_scaling.py --save baseline.json
+    python benchmarks/bench_scaling.py --compare baseline.json
+
+For every case the number of runs, the throughput and the latency
+percentiles are reported, plus the peak memory: the peak of Python
+allocations (tracemalloc) and the growth of the maximum resident set size of
+the process.  Pillow allocates image memory outside of the Python allocator,
+so the latter is needed to see it, but it only grows when a case needs more
+memory than all cases before it.
+
+With ``--compare``, the median latency of each case is compared to the saved
+baseline and the exit code is 1 when a case got slower by more than the
+``--threshold`` fraction.
+"""
+
+from io import BytesIO
+from plone.scale.scale import scale_svg_image
+from plone.scale.scale import scaleImage
+
+import argparse
+import json
+import PIL.Image
+import PIL.ImageDraw
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+import warnings
+
+# Scales of a default Plone site: name -> (width, height).
+PLONE_SCALES = {
+    "huge": (1600, 65536),
+    "great": (1200, 65536),
+    "larger": (1000, 65536),
+    "large": (800, 65536),
+    "teaser": (600, 65536),
+    "preview": (400, 65536),
+    "mini": (200, 65536),
+    "thumb": (128, 128),
+    "tile": (64, 64),
+    "icon": (32, 32),
+    "listing": (16, 16),
+}
+QUICK_SCALES = ("large", "preview", "thumb")
+MODES = ("scale", "contain", "cover")
+
+
+def _photo(size, mode="RGB"):
+    """Generate a photo-like image: gradients plus noise."""
+    width, height = size
+    red = PIL.Image.linear_gradient("L").resize(size)
+    green = PIL.Image.radial_gradient("L").resize(size)
+    blue = PIL.Image.effect_noise(size, 64)
+    image = PIL.Image.merge("RGB", (red, green, blue))
+    draw = PIL.ImageDraw.Draw(image)
+    for index in range(20):
+        x = (index * 97) % width
+        y = (index * 61) % height
+        draw.ellipse(
+            (x, y, x + width // 8, y + height // 8), fill=(index * 12, 80, 160)
+        )
+    if mode != "RGB":
+        image = image.convert(mode)
+    return image
+
+
+def _encode(image, format_, **kwargs):
+    result = BytesIO()
+    image.save(result, format_, **kwargs)
+    return result.getvalue()
+
+
+def _animation(size, frames=8):
+    images = [_photo(size).rotate(index * 10).quantize(64) for index in range(frames)]
+    return images[0], images[1:]
+
+
+def generate_images(size):
+    """Return a dict of name -> encoded image data."""
+    photo = _photo(size)
+    first, rest = _animation((size[0] // 4, size[1] // 4))
+    return {
+        "jpeg": _encode(photo, "JPEG", quality=90),
+        "png": _encode(photo, "PNG"),
+        "webp": _encode(photo, "WEBP", quality=90),
+        "gif": _encode(photo.quantize(256), "GIF"),
+        "cmyk-jpeg": _encode(photo.convert("CMYK"), "JPEG", quality=90),
+        "palette-png": _encode(photo.quantize(64), "PNG"),
+        "animated-gif": _encode(
+            first, "GIF", save_all=True, append_images=rest, duration=100, loop=0
+        ),
+        "animated-webp": _encode(
+            first.convert("RGBA"),
+            "WEBP",
+            save_all=True,
+            append_images=[image.convert("RGBA") for image in rest],
+            duration=100,
+            loop=0,
+        ),
+    }
+
+
+def generate_svg(elements):
+    paths = "\n".join(
+        f'<path d="M{index % 100} {index % 70} l10 10 l-5 7 z" fill="#{index % 4096:03x}"/>'
+        for index in range(elements)
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="100" height="70" '
+        f'viewBox="0 0 100 70">\n{paths}\n</svg>\n'
+    ).encode("utf-8")
+
+
+def _max_rss_kib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes instead of kilobytes
+        rss //= 1024
+    return rss
+
+
+def measure(func, min_runs, min_time):
+    """Run func repeatedly and return the statistics."""
+    # Warm up, and measure memory during the first run.
+    rss_before = _max_rss_kib()
+    tracemalloc.start()
+    func()
+    peak_python = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss_growth = _max_rss_kib() - rss_before
+
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_runs or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+    total = sum(timings)
+    return dict(
+        runs=len(timings),
+        throughput=len(timings) / total if total else 0.0,
+        mean_ms=statistics.mean(timings) * 1000,
+        p50_ms=percentile(0.5) * 1000,
+        p95_ms=percentile(0.95) * 1000,
+        p99_ms=percentile(0.99) * 1000,
+        peak_python_kib=peak_python // 1024,
+        max_rss_growth_kib=rss_growth,
+    )
+
+
+def scale_cases(images, scales, modes):
+    for name, data in images.items():
+        for mode in modes:
+            for scale in scales:
+                width, height = PLONE_SCALES[scale]
+                yield (
+                    f"scaleImage:{name}:{mode}:{scale}",
+                    lambda data=data, width=width, height=height, mode=mode: (
+                        scaleImage(data, width, height, mode)
+                    ),
+                )
+
+
+def svg_cases():
+    for name, elements in (("small", 10), ("large", 20000)):
+        data = generate_svg(elements)
+        for mode in MODES:
+            yield (
+                f"scale_svg_image:{name}:{mode}",
+                lambda data=data, mode=mode: scale_svg_image(
+                    BytesIO(data), 400, 300, mode
+                ),
+            )
+
+
+def storage_cases(stored_scales):
+    try:
+        from plone.scale.interfaces import IImageScaleFactory
+        from plone.scale.storage import AnnotationStorage
+        from zope.annotation.attribute import AttributeAnnotations
+        from zope.annotation.interfaces import IAttributeAnnotatable
+        from zope.component import adapter
+        from zope.component import provideAdapter
+        from zope.interface import implementer
+    except ImportError:
+        print("Skipping storage benchmarks: storage requirements are missing.")
+        return
+
+    class Original:
+        contentType = "image/jpeg"
+
+        def getImageSize(self):
+            return 4000, 3000
+
+    @implementer(IAttributeAnnotatable)
+    class Content:
+        pass
+
+    @implementer(IImageScaleFactory)
+    @adapter(Content)
+    class Factory:
+        def __init__(self, context):
+            self.context = context
+
+        def __call__(self, **parameters):
+            return b"scale data" * 1000, "jpeg", (400, 300)
+
+        def get_original_value(self, fieldname=None):
+            return Original()
+
+    provideAdapter(AttributeAnnotations)
+    provideAdapter(Factory)
+
+    def make_storage():
+        storage = AnnotationStorage(Content(), modified=lambda: 42)
+        for index in range(stored_scales):
+            storage.scale(fieldname="image", width=index + 1, height=65536)
+        return storage
+
+    storage = make_storage()
+    srcset = [dict(fieldname="image", width=width) for width in (400, 800, 1200, 1600)]
+    storage.pre_scale_many(srcset)
+    uid = storage.pre_scale(fieldname="image", width=400)["uid"]
+    storage.get_or_generate(uid)
+    yield "storage:pre_scale:existing", lambda: storage.pre_scale(
+        fieldname="image", width=400
+    )
+    yield "storage:pre_scale_many:existing", lambda: storage.pre_scale_many(srcset)
+    yield "storage:scale:existing", lambda: storage.scale(
+        fieldname="image", width=1, height=65536
+    )
+    yield "storage:get_or_generate:existing", lambda: storage.get_or_generate(uid)
+    yield "storage:get_info_by_hash:missing", lambda: storage.get_info_by_hash(())
+    yield "storage:cleanup", storage._cleanup
+    yield "storage:create", make_storage
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        change = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        marker = ""
+        if change > threshold:
+            marker = "  REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:55} {old['p50_ms']:10.3f} -> {result['p50_ms']:10.3f} ms"
+            f" {change:+8.1%}{marker}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--size",
+        default="3000x2000",
+        help="Size of the generated original images (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="Use all Plone scales, not just a few"
+    )
+    parser.add_argument(
+        "--stored-scales",
+        type=int,
+        default=50,
+        help="Number of scales stored for the storage benchmarks",
+    )
+    parser.add_argument("--min-runs", type=int, default=5)
+    parser.add_argument(
+        "--min-time", type=float, default=0.5, help="Minimum seconds per case"
+    )
+    parser.add_argument("--filter", default="", help="Only run matching cases")
+    parser.add_argument("--save", help="Save the results as JSON to this file")
+    parser.add_argument("--compare", help="Compare with results saved before")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Allowed slowdown of the median latency (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    size = tuple(int(part) for part in args.size.split("x"))
+    scales = tuple(PLONE_SCALES) if args.full else QUICK_SCALES
+    cases = []
+    cases.extend(scale_cases(generate_images(size), scales, MODES))
+    cases.extend(svg_cases())
+    cases.extend(storage_cases(args.stored_scales))
+
+    results = {}
+    print(
+        f"{'case':55} {'runs':>5} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9}"
+        f" {'p99 ms':>9} {'py KiB':>8} {'rss KiB':>8}"
+    )
+    for name, func in cases:
+        if args.filter not in name:
+            continue
+        result = results[name] = measure(func, args.min_runs, args.min_time)
+        print(
+            f"{name:55} {result['runs']:5} {result['throughput']:9.1f}"
+            f" {result['p50_ms']:9.3f} {result['p95_ms']:9.3f}"
+            f" {result['p99_ms']:9.3f} {result['peak_python_kib']:8}"
+            f" {result['max_rss_growth_kib']:8}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as result_file:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    pillow=PIL.__version__,
+                    size=args.size,
+                    results=results,
+                ),
+                result_file,
+                indent=2,
+                sort_keys=True,
+            )
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("size") != args.size:
+            print(f"Warning: the baseline used size {baseline.get('size')}")
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} cases got slower than the baseline.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
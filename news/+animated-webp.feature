@@ -0,0 +1,3 @@
+Scale animated GIF images to animated WEBP images with ``output_format="WEBP"``.
+These use the normal resampling instead of nearest neighbour, and are much smaller than GIF.
+Scaled animations keep the frame durations and loop count of the original.
@@ -0,0 +1,4 @@
+Add ``plone.scale.background.ScaleQueue``, a priority queue with worker
+threads for generating scales in the background.
+When set as ``queue`` on ``AnnotationStorage``, ``pre_scale`` queues new scales
+after the transaction commits, with an optional ``priority``.
@@ -0,0 +1,5 @@
+Reduce very large uncompressed originals (TIFF, BMP, PPM) band by band while
+reading them, so scaling them needs memory proportional to the target size
+instead of the size of the original.  Pillow still refuses to open images with
+more than twice ``PIL.Image.MAX_IMAGE_PIXELS`` pixels, about 179 million by
+default, so raise that limit to scale bigger originals.
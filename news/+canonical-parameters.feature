@@ -0,0 +1,3 @@
+Make scale parameters canonical before computing the uid of a scale.
+Alternative spellings of a mode, the deprecated ``direction``, and a width or height that is ignored by the scaling no longer create separate scales.
+Scales stored with the uids of earlier versions are still found.
@@ -0,0 +1,2 @@
+Crop and scale images with ``contain`` and ``cover`` in a single resampling step, straight to the final size.
+This avoids intermediate images, and the part of the original that is used is now centered exactly instead of shifted by rounding.
@@ -0,0 +1,6 @@
+Add ``plone.scale.bytecache.ScaleDataCache``, an in-memory LRU cache of scale
+data limited by size in bytes, with hit, miss and eviction counters.
+Set it as ``data_cache`` on ``AnnotationStorage`` to serve popular scales from
+memory: ``get_or_generate`` and the new ``get_data`` method fill and use the
+cache, and ``scale`` uses data that is already cached.  Data that the image
+scale factory returns as a blob is only cached by ``get_data``.
@@ -0,0 +1,4 @@
+Add an optional ``instrument`` argument to ``scaleImage`` and ``scalePILImage``.
+Pass a ``plone.scale.instrument.ScaleInstrument`` to get wall and CPU time,
+pixel counts, input and output bytes and format decisions of the separate
+scaling stages.  Without it, no measurements are done.
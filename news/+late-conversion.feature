@@ -0,0 +1,3 @@
+Convert black and white, palette and CMYK images as late as possible while scaling: after decoding JPEG images in draft mode and after cropping.
+With nearest neighbour resampling, like for animations, only the scaled image is converted.
+This makes scaling CMYK JPEG images about twice as fast.
@@ -0,0 +1,3 @@
+Store the data of generated scales as separate persistent objects.
+Looking up or registering a scale no longer loads the data of all scales of an image from the database: the data is only loaded when it is used.
+Scales stored by older versions keep working.
@@ -0,0 +1,3 @@
+Add a ``max_bytes`` option to ``scaleImage``.
+JPEG, WEBP and AVIF scales are then saved with the highest quality that gives at most this many bytes, for example for social media previews or newsletters with size limits.
+With ``passthrough``, originals with more than ``max_bytes`` bytes are still scaled.
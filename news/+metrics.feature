@@ -0,0 +1,5 @@
+Report storage metrics: ``scale`` hits and misses, ``pre_scale`` reuse,
+``get_or_generate`` generations, cleanup deletions, conflict resolution
+outcomes, and timings of these operations and of scale generation.  Set a sink
+with ``plone.scale.metrics.set_sink``, for example a ``PrometheusSink`` that
+renders the Prometheus text format or writes it to a local file.
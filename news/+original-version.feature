@@ -0,0 +1,3 @@
+Key scales on the version of the original image when the ``IImageScaleFactory``
+has the new optional ``get_original_version`` method, for example returning a
+digest of the image.  Scales then survive edits that do not change the image.
@@ -0,0 +1,3 @@
+Add an ``output_format`` option to ``scaleImage``, to save a scale as for example WEBP or AVIF instead of in the format based on the original.
+Add ``pre_scale_variants`` and ``negotiate`` to the scale storage: register a scale together with variants in other formats, and pick the variant that fits the ``Accept`` header of a request.
+With a ``signing_key`` the variants are not stored, so negotiate with the info returned by ``pre_scale_variants``.
@@ -0,0 +1,3 @@
+Add a ``passthrough`` option to ``scaleImage``.
+When scaling would not change the size or the format of a JPEG, PNG or WEBP image, the original data is returned instead of being decoded and encoded again.
+Images with EXIF data are still scaled, because scaling removes that data.
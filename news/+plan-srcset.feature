@@ -0,0 +1,2 @@
+Add ``plan_srcset`` function, which returns the scales of an image that are worth generating for a srcset.
+It leaves out candidates that would upscale the original, and candidates that are (almost) the same size as a bigger one.
@@ -0,0 +1,3 @@
+Add ``AnnotationStorage.pre_scale_many`` to pre-register a list of scales,
+for example all entries of a ``srcset``, with a single lookup of the original
+image and a single storage write.
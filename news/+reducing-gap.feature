@@ -0,0 +1,2 @@
+Scale large images in two steps: first reduce them with a fast box filter to a few times the target size, then resample to the final size.
+This makes scaling big originals much faster with practically the same quality.
@@ -0,0 +1,3 @@
+Resolve conflicts in ``ScalesDict`` when two transactions added or generated
+the same scale with the same parameters, instead of raising ``ConflictError``.
+A generated scale is preferred over a placeholder.
@@ -0,0 +1,2 @@
+When ``pre_scale`` registers a scale with the same final dimensions, mode and other parameters as an existing scale, it returns the existing scale and stores the new uid as an alias of it.
+For example all srcset widths that are bigger than a small original now share one generated scale.
@@ -0,0 +1,4 @@
+Add a write-free ``pre_scale`` mode to ``AnnotationStorage``.
+When ``signing_key`` is set, the scale parameters are encoded in a signed uid
+instead of a stored placeholder, so ``get_or_generate`` can reconstruct them
+and rendering a page no longer writes to the database.
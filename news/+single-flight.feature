@@ -0,0 +1,4 @@
+Add ``plone.scale.singleflight.SingleFlight``.
+Set it as ``single_flight`` on ``AnnotationStorage`` so concurrent
+``get_or_generate`` calls for the same scale in one process only generate it
+once.
@@ -0,0 +1,4 @@
+Add ``max_staleness`` to ``AnnotationStorage``.
+When a background ``queue`` is set, ``scale`` returns an outdated scale
+that is at most this many milliseconds old, and queues its regeneration
+instead of regenerating it inline.
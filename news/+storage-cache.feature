@@ -0,0 +1,3 @@
+Add an opt-in ``cache`` argument to ``AnnotationStorage`` that resolves the
+modification time and the annotation lookup only once per transaction.
+The cache is invalidated whenever the storage is written.
@@ -0,0 +1,2 @@
+Add a ``to_srgb`` option to ``scaleImage``, to convert images with an ICC color profile to sRGB, before or after scaling.
+The scale then has no embedded profile, which can make small scales of images with big profiles, like CMYK photos, hundreds of kilobytes smaller.
@@ -10,6 +10,7 @@ long_description = (
 STORAGE_REQUIREMENTS = [
     "ZODB",
     "persistent",
+    "transaction",
 ]
 
 TEST_REQUIREMENTS = [
@@ -0,0 +1,102 @@
+from queue import PriorityQueue
+
+import itertools
+import logging
+import math
+import threading
+
+logger = logging.getLogger("plone.scale")
+
+# Jobs with lower numbers are generated first.
+HIGH_PRIORITY = 0
+DEFAULT_PRIORITY = 10
+LOW_PRIORITY = 20
+
+
+class ScaleJob:
+    """A scale that should be generated in the background.
+
+    ``context_key`` identifies the content item outside of the current
+    transaction, see ``AnnotationStorage.context_key``.
+    """
+
+    def __init__(self, context_key, uid, parameters, priority=DEFAULT_PRIORITY):
+        self.context_key = context_key
+        self.uid = uid
+        self.parameters = parameters
+        self.priority = priority
+
+    def __repr__(self):
+        name = self.__class__.__name__
+        return f"<{name} uid={self.uid!r} priority={self.priority!r}>"
+
+
+class ScaleQueue:
+    """Generate scales in background worker threads, by priority.
+
+    ``runner`` is called with a :class:`ScaleJob` in a worker thread.
+    It needs to open its own database connection, look up the content item
+    by ``job.context_key``, call ``process_job(job)`` on its image scale
+    storage and commit.
+
+    A job for a scale that is already waiting in the queue is ignored.
+    """
+
+    def __init__(self, runner, workers=1):
+        self.runner = runner
+        self.workers = workers
+        self._queue = PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._threads = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, job):
+        """Add a job.  Returns False if the scale is already queued."""
+        key = (job.context_key, job.uid)
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        # The counter keeps jobs with the same priority in order.
+        self._queue.put((job.priority, next(self._counter), job))
+        return True
+
+    def start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._work, name="plone.scale worker", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop the workers after the queued jobs have been done."""
+        for thread in self._threads:
+            self._queue.put((math.inf, next(self._counter), None))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self):
+        """Wait until all queued jobs have been done."""
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            priority, counter, job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                logger.debug(f"Processing {job!r}")
+                self.runner(job)
+            except Exception:
+                logger.exception(f"Could not process {job!r}")
+            finally:
+                if job is not None:
+                    with self._lock:
+                        self._pending.discard((job.context_key, job.uid))
+                self._queue.task_done()
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+import threading
+
+# Default size of the cache: 64 MB.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ScaleDataCache:
+    """Least recently used cache of scale data, limited by size in bytes.
+
+    This is meant to be shared by all storages in a process, for the data of
+    a few very popular scales, like a site logo.  Data bigger than the whole
+    budget is not cached.  The ``hits``, ``misses`` and ``evictions``
+    counters can be used to tune the size.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def set(self, key, data):
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = data
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            data = self._items.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            items=len(self._items),
+            size=self.size,
+        )
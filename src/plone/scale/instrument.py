@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from contextlib import nullcontext
+
+import time
+
+
+class ScaleInstrument:
+    """Collect timings and details of the stages of ``scaleImage``.
+
+    Pass an instance as the ``instrument`` argument of ``scaleImage``.
+    Each stage is reported as a dict with its ``name``, the ``wall`` and
+    ``cpu`` time in seconds, and stage specific details like pixel counts.
+    The stages are: ``open``, ``reduce``, ``decode``, ``convert``,
+    ``color``, ``resize``, ``analyse`` and ``save``.  A stage that raises an
+    error is reported as well.
+
+    ``details`` has information about the whole operation, like the input
+    and output size in bytes and the chosen output format.
+
+    Override ``report`` to send the stages elsewhere instead of collecting
+    them in ``stages``.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.details = {}
+
+    @contextmanager
+    def stage(self, name, **details):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.report(
+                dict(
+                    name=name,
+                    wall=time.perf_counter() - wall,
+                    cpu=time.process_time() - cpu,
+                    **details,
+                )
+            )
+
+    def record(self, **details):
+        self.details.update(details)
+
+    def report(self, stage):
+        self.stages.append(stage)
+
+
+class NullInstrument:
+    """Instrument that does nothing.  Used when instrumentation is off."""
+
+    _context = nullcontext()
+
+    def stage(self, name, **details):
+        return self._context
+
+    def record(self, **details):
+        pass
+
+
+NULL_INSTRUMENT = NullInstrument()
@@ -38,7 +38,10 @@ class IImageScaleFactory(Interface):
              additional information such as cropping boxes.
 
         ``**parameters``
-            is a dict with optional additional expected keyword arguments
+            is a dict with optional additional expected keyword arguments.
+            This includes ``output_format`` for scales registered with
+            ``pre_scale_variants``, which should be passed on to
+            ``scaleImage``.
 
         Expected to return a triple of ``value, format, dimensions``
         or ``None`` on failure.
@@ -61,3 +64,16 @@ class IImageScaleFactory(Interface):
         If not passed, and there is no self.fieldname set,
         you can try to get it in a different way.
         """
+
+    def get_original_version(fieldname=None):
+        """Get a value identifying the version of the original image.
+
+        This is optional.  It can for example be a digest of the image data.
+        When it returns something other than None, scales are keyed on this
+        value instead of on the modification time of the context, so they
+        survive edits that do not change the image.
+
+        The storage only asks for the version again when the modification
+        time of the context changes, so changing the image must also change
+        the modification time.
+        """
@@ -0,0 +1,192 @@
+"""Metrics of the scale storage.
+
+The storage reports counters and timings to the current metrics sink.
+By default this is a sink that ignores everything.  Call ``set_sink`` with
+for example a :class:`PrometheusSink` to collect them.
+
+Reported counters:
+
+``scale``
+    Calls of ``AnnotationStorage.scale``, labelled with ``result``:
+    ``hit``, ``stale`` or ``miss``.
+``pre_scale``
+    Scales requested via ``pre_scale``, labelled with ``result``:
+    ``reused`` or ``new``.
+``get_or_generate``
+    Calls of ``get_or_generate``, labelled with ``result``:
+    ``hit``, ``generated`` or ``not_found``.
+``cleanup_deleted``
+    Scales deleted by the cleanup of outdated scales.
+``conflict``
+    Conflicts in the scales storage, labelled with ``result``:
+    ``resolved`` or ``raised``.
+
+Reported timings, in seconds:
+
+``generate``
+    Generating a scale with the image scale factory.
+``scale``, ``pre_scale`` and ``get_or_generate``
+    Calls of these storage methods, including any generation.
+    ``pre_scale`` also times ``pre_scale_many``.
+``cleanup``
+    The cleanup of outdated scales.
+``conflict``
+    Resolving a conflict in the scales storage, also when it is raised.
+"""
+
+from collections import defaultdict
+from time import perf_counter
+
+import functools
+import os
+import tempfile
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class NullSink:
+    """Metrics sink that ignores everything."""
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+
+class PrometheusSink:
+    """Metrics sink that keeps counters and histograms in memory.
+
+    ``render`` returns them in the Prometheus text exposition format.
+    ``write`` writes that to a file, for example for the textfile collector
+    of the Prometheus node exporter.
+    """
+
+    def __init__(self, prefix="plone_scale", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # key -> [bucket counts..., sum, count]
+        self._histograms = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    def histogram_count(self, name, **labels):
+        histogram = self._histograms.get(self._key(name, labels))
+        return histogram[-1] if histogram else 0
+
+    def _labels(self, labels, **extra):
+        labels = list(labels) + list(extra.items())
+        if not labels:
+            return ""
+        text = ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for name, value in labels
+        )
+        return "{" + text + "}"
+
+    def _number(self, value):
+        if float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{self._labels(labels)} {self._number(value)}")
+        for (name, labels), histogram in histograms:
+            metric = f"{self.prefix}_{name}_seconds"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(
+                    f"{metric}_bucket{self._labels(labels, le=self._number(bound))}"
+                    f" {count}"
+                )
+            lines.append(
+                f"{metric}_bucket{self._labels(labels, le='+Inf')} {histogram[-1]}"
+            )
+            lines.append(
+                f"{metric}_sum{self._labels(labels)} {self._number(histogram[-2])}"
+            )
+            lines.append(f"{metric}_count{self._labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to a file, atomically."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write(self.render())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+_sink = NullSink()
+
+
+def get_sink():
+    return _sink
+
+
+def set_sink(sink):
+    """Set the metrics sink.  Pass None to disable metrics again."""
+    global _sink
+    _sink = NullSink() if sink is None else sink
+
+
+def timed(name):
+    """Decorator that reports the duration of each call as a timing."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                get_sink().observe(name, perf_counter() - start)
+
+        return wrapper
+
+    return decorator
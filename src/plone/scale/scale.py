@@ -1,9 +1,11 @@
+from .instrument import NULL_INSTRUMENT
 from lxml import etree
 
 import codecs
 import io
 import logging
 import math
+import PIL.features
 import PIL.Image
 import PIL.ImageFile
 import PIL.ImageSequence
@@ -11,6 +13,12 @@ import re
 import sys
 import warnings
 
+try:
+    from PIL import ImageCms
+except ImportError:
+    # Pillow without littlecms
+    ImageCms = None
+
 try:
     # Pillow 9.1.0+
     LANCZOS = PIL.Image.Resampling.LANCZOS
@@ -31,6 +39,20 @@ logger = logging.getLogger(__name__)
 # a height of 0 or less is ignored.
 MAX_HEIGHT = 65000
 
+# Formats that can be requested as output format of scaleImage.
+OUTPUT_FORMATS = ("JPEG", "PNG", "GIF", "WEBP", "AVIF")
+
+# Profile to convert images to with the to_srgb option of scaleImage.
+# Created when first needed.
+SRGB_PROFILE = None
+# Rounding difference allowed when checking if a profile is sRGB.
+SRGB_TOLERANCE = 2
+
+# Lossy formats, for which scaleImage can search a quality for max_bytes.
+LOSSY_FORMATS = ("JPEG", "WEBP", "AVIF")
+# Lowest quality used to stay within max_bytes.
+MIN_QUALITY = 10
+
 FLOAT_RE = re.compile(r"(?:\d*\.\d+|\d+)")
 
 
@@ -54,6 +76,29 @@ PIL.ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 MAX_PIXELS = 8192 * 8192
 
+# Originals with more pixels than this are reduced band by band while reading
+# them, when the file stores uncompressed rows, like uncompressed TIFF, BMP or
+# PPM.  This keeps memory use proportional to the target size instead of the
+# size of the original.  Note that Pillow refuses to open images with more
+# than twice PIL.Image.MAX_IMAGE_PIXELS pixels (about 179 million by default).
+# Raise that limit to scale bigger originals of these formats.
+BAND_REDUCE_PIXELS = 64 * 1024 * 1024
+
+# Size in bytes of the bands that are read at once.
+BAND_BYTES = 16 * 1024 * 1024
+
+# For large reductions, first reduce the image by an integer factor with a
+# fast box filter, and only then resample it with the (slow) resample filter.
+# The intermediate image is at least this many times larger than the target.
+# Pillow documents 3.0 as giving results indistinguishable from resampling
+# the full image.  Set to None to always resample the full image.
+REDUCING_GAP = 3.0
+
+# Only use the reducing step for originals with more pixels than this.
+# Resampling smaller images is fast anyway, and this keeps their results
+# exactly as before.
+REDUCING_MIN_PIXELS = 1024 * 1024
+
 
 def scaleImage(
     image,
@@ -63,6 +108,11 @@ def scaleImage(
     quality=88,
     result=None,
     direction=None,
+    instrument=None,
+    passthrough=False,
+    output_format=None,
+    max_bytes=None,
+    to_srgb=None,
 ):
     """Scale the given image data to another size and return the result
     as a string or optionally write in to the file-like `result` object.
@@ -83,38 +133,129 @@ def scaleImage(
     The generated image is a JPEG image, unless the original is a WEBP, PNG
     or GIF image. This is needed to make sure alpha channel information is
     not lost, which JPEG does not support.
+
+    Pass a :class:`plone.scale.instrument.ScaleInstrument` as `instrument`
+    to get timings and details of the separate scaling stages.
+
+    With `passthrough`, the original data is returned unchanged when
+    scaling would not change the size or the format, instead of decoding and
+    encoding it again.  This is not the default, because the original may
+    contain metadata that scaling removes, although images with EXIF data
+    are always scaled.  So are originals with more than `max_bytes` bytes,
+    and originals with an ICC profile when `to_srgb` is used.
+
+    Use `output_format` to request a format, like "WEBP" or "AVIF", instead
+    of the format based on the original.  :func:`supports_output_format`
+    tells which formats are available.  A JPEG image with transparency is
+    still saved as PNG instead.  Animated GIF and WEBP images stay animated
+    with "WEBP", which is much smaller than GIF and is scaled with the
+    normal resampling instead of nearest neighbour.
+
+    With `max_bytes`, JPEG, WEBP and AVIF images are saved with the highest
+    quality, up to `quality`, that gives at most this many bytes.  When even
+    `MIN_QUALITY` gives more bytes, the image is saved with that quality.
+    Other formats are lossless and are saved as usual.
+
+    The ICC color profile of the original is embedded in the scale.  With
+    `to_srgb`, images with another profile are converted to sRGB instead,
+    "before" or (faster) "after" scaling, and the scale has no profile:
+    browsers assume sRGB.  CMYK images are always converted before scaling.
+    Animations and greyscale images keep their profile.
     """
+    if instrument is None:
+        instrument = NULL_INSTRUMENT
+    if to_srgb not in (None, "before", "after"):
+        raise ValueError(f"to_srgb must be 'before' or 'after', not '{to_srgb}'")
+    if output_format is not None:
+        output_format = output_format.upper()
+        if output_format == "JPG":
+            output_format = "JPEG"
+        if not supports_output_format(output_format):
+            raise ValueError(f"Unsupported output format '{output_format}'")
     if isinstance(image, (bytes, str)):
+        instrument.record(input_bytes=len(image))
         image = io.BytesIO(image)
+    if passthrough:
+        start = image.tell()
 
     save_kwargs = {}
-    with PIL.Image.open(image) as img:
+    with instrument.stage("open"):
+        img = PIL.Image.open(image)
+    with img:
         icc_profile = img.info.get("icc_profile")
         # When we create a new image during scaling we lose the format
         # information, so remember it here.
         format_ = img.format
-        if format_ in ("GIF", "WEBP") and img.is_animated:
+        instrument.record(
+            input_format=format_,
+            input_mode=img.mode,
+            input_size=img.size,
+        )
+        if (
+            passthrough
+            and output_format in (None, format_)
+            and (max_bytes is None or _remaining_bytes(image, start) <= max_bytes)
+            and not (to_srgb and icc_profile)
+            and _may_pass_through(img, width, height, mode, direction)
+        ):
+            image.seek(start)
+            data = image.read()
+            if result is None:
+                result = data
+            else:
+                result.write(data)
+                result.seek(0)
+            instrument.record(
+                passthrough=True,
+                frames=1,
+                output_bytes=len(data),
+                output_format=format_,
+                output_mode=img.mode,
+                size=img.size,
+            )
+            return result, format_, img.size
+        if (
+            format_ in ("GIF", "WEBP")
+            and img.is_animated
+            and output_format in (None, format_, "WEBP")
+        ):
+            if output_format is not None:
+                format_ = output_format
+            if format_ == "GIF":
+                # The default resampling creates more colors,
+                # which interferes with optimizing animated GIF size
+                # by omitting parts of the frame that haven't changed.
+                # Using NEAREST won't look as good,
+                # but avoids saving scaled animated GIFs
+                # that are much larger than the original.
+                resample = NEAREST
+            else:
+                # WEBP has no palette, so it does not have this problem.
+                resample = RESAMPLE
             # Process multiple frames, to support animations
             append_images = []
+            durations = []
             for frame in PIL.ImageSequence.Iterator(img):
+                # The frame is copied, because scaling may change it in place.
+                # Copying loads it, which sets the duration for WEBP.
+                frame = frame.copy()
+                durations.append(frame.info.get("duration"))
                 # Call scalePILImage directly to avoid converting to palette mode,
-                # which interferes with optimized saving of the animation
-                frame = frame.convert("RGBA")
+                # which interferes with optimized saving of the animation.
                 scaled_frame = scalePILImage(
                     frame,
                     width=width,
                     height=height,
                     mode=mode,
                     direction=direction,
-                    # The default resampling creates more colors,
-                    # which interferes with optimizing animated GIF size
-                    # by omitting parts of the frame that haven't changed.
-                    # Using NEAREST won't look as good,
-                    # but avoids saving scaled animated GIFs
-                    # that are much larger than the original.
-                    resample=NEAREST,
+                    resample=resample,
+                    instrument=instrument,
                 )
-                append_images.append(scaled_frame)
+                # With NEAREST, converting the scaled frame instead of the
+                # original frame gives the same result for fewer pixels.
+                append_images.append(scaled_frame.convert("RGBA"))
+
+            instrument.record(frames=len(append_images))
 
             # The first image is the basis for save
             # All other images than the first will be added as a save parameter
@@ -123,6 +264,14 @@ def scaleImage(
                 # Saving as a multi page image
                 save_kwargs["save_all"] = True
                 save_kwargs["append_images"] = append_images
+                if None not in durations:
+                    save_kwargs["duration"] = durations
+                if "loop" in img.info:
+                    save_kwargs["loop"] = img.info["loop"]
+                elif format_ == "WEBP":
+                    # A GIF without loop count is played once.
+                    # For WEBP, the default of zero means forever.
+                    save_kwargs["loop"] = 1
             elif format_ == "GIF":
                 # PNG looks better if we have 8-bit alpha and no palette,
                 # but it only works for single frame, so don't do this for animated GIFs.
@@ -130,45 +279,160 @@ def scaleImage(
 
         else:
             # No animation; just scale single frame
-            if format_ == "GIF":
+            instrument.record(frames=1)
+            if output_format is not None:
+                format_ = output_format
+            elif format_ == "GIF":
                 # PNG looks better if we have 8-bit alpha and no palette.
                 # (It only works for single frame, so we don't do this for animated GIFs.)
                 format_ = "PNG"
             elif format_ not in ("PNG", "WEBP"):
                 format_ = "JPEG"
-            image, format_ = scaleSingleFrame(
-                img,
-                width=width,
-                height=height,
-                mode=mode,
-                format_=format_,
-                quality=quality,
-                direction=direction,
-            )
+            source = img
+            reduced = None
+            if img.width * img.height > BAND_REDUCE_PIXELS:
+                with instrument.stage("reduce", pixels=img.width * img.height):
+                    reduced = _band_reduce_for(img, width, height, mode, direction)
+                if reduced is not None:
+                    source, box, size = reduced
+            # Converting to sRGB after scaling is faster, but CMYK can only
+            # be converted with its profile before scaling.
+            convert_before = to_srgb == "before" or source.mode == "CMYK"
+            if to_srgb and icc_profile and convert_before:
+                if reduced is None:
+                    # Only convert the pixels that JPEG draft mode decodes.
+                    reduced = _draft_for(source, width, height, mode, direction)
+                    if reduced is not None:
+                        source, box, size = reduced
+                source, icc_profile = _to_srgb(source, icc_profile, instrument)
+            if reduced is not None:
+                image = _crop_resize(source, size, box, RESAMPLE, instrument)
+            else:
+                image = scalePILImage(
+                    source,
+                    width=width,
+                    height=height,
+                    mode=mode,
+                    direction=direction,
+                    instrument=instrument,
+                )
+            if to_srgb and icc_profile and not convert_before:
+                image, icc_profile = _to_srgb(image, icc_profile, instrument)
+            image, format_ = _simplify_mode(image, format_, instrument)
 
     new_result = False
     if result is None:
         result = io.BytesIO()
         new_result = True
 
-    image.save(
-        result,
-        format_,
-        quality=quality,
-        optimize=True,
-        progressive=True,
-        icc_profile=icc_profile,
-        **save_kwargs,
-    )
+    save_kwargs.update(optimize=True, progressive=True, icc_profile=icc_profile)
+    with instrument.stage("save", format=format_, mode=image.mode):
+        if max_bytes is not None and format_ in LOSSY_FORMATS:
+            data, quality, attempts = _encode_within(
+                image, format_, max_bytes, quality, **save_kwargs
+            )
+            result.write(data)
+            instrument.record(quality=quality, encode_attempts=attempts)
+        else:
+            image.save(result, format_, quality=quality, **save_kwargs)
 
     if new_result:
         result = result.getvalue()
+        instrument.record(output_bytes=len(result))
     else:
+        instrument.record(output_bytes=result.tell())
         result.seek(0)
+    instrument.record(output_format=format_, output_mode=image.mode, size=image.size)
 
     return result, format_, image.size
 
 
+def _encode(image, format_, quality, **kwargs):
+    result = io.BytesIO()
+    image.save(result, format_, quality=quality, **kwargs)
+    return result.getvalue()
+
+
+def _encode_within(image, format_, max_bytes, quality, **kwargs):
+    """Encode the image with the highest quality that fits in `max_bytes`.
+
+    This is a binary search between `MIN_QUALITY` and `quality`.  Returns
+    the data, the used quality and the number of encodings.
+    """
+    data = _encode(image, format_, quality, **kwargs)
+    attempts = 1
+    if len(data) <= max_bytes or quality <= MIN_QUALITY:
+        return data, quality, attempts
+    best = None
+    low = MIN_QUALITY
+    high = quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        data = _encode(image, format_, middle, **kwargs)
+        attempts += 1
+        if len(data) <= max_bytes:
+            best = data, middle
+            low = middle + 1
+        else:
+            high = middle - 1
+    if best is None:
+        # Nothing fits: use the lowest quality.
+        if middle != MIN_QUALITY:
+            data = _encode(image, format_, MIN_QUALITY, **kwargs)
+            attempts += 1
+        return data, MIN_QUALITY, attempts
+    return best[0], best[1], attempts
+
+
+def supports_output_format(format_):
+    """Can scales be saved in this format?
+
+    This is one of `OUTPUT_FORMATS`, when Pillow can save it.
+    """
+    format_ = format_.upper()
+    if format_ not in OUTPUT_FORMATS:
+        return False
+    PIL.Image.init()
+    if format_ not in PIL.Image.SAVE:
+        return False
+    feature = format_.lower()
+    if feature in PIL.features.modules:
+        # For example Pillow without libwebp or libavif.
+        return bool(PIL.features.check(feature))
+    return True
+
+
+def _remaining_bytes(stream, start):
+    """Return the number of bytes in a stream after `start`."""
+    position = stream.tell()
+    try:
+        return stream.seek(0, io.SEEK_END) - start
+    finally:
+        stream.seek(position)
+
+
+def _may_pass_through(image, width, height, mode, direction):
+    """Would scaling give an image with the same size and format?
+
+    This only uses information from the header of the image.
+    """
+    if image.format not in ("JPEG", "PNG", "WEBP"):
+        # Other formats are converted.
+        return False
+    if getattr(image, "is_animated", False) or image.mode == "CMYK":
+        return False
+    if "exif" in image.info:
+        # Scaling removes EXIF data, which may contain private information.
+        return False
+    if not width and not height:
+        # scalePILImage raises an error for this.
+        return False
+    size = calculate_scaled_dimensions(
+        image.width, image.height, width, height, get_scale_mode(mode, direction)
+    )
+    return size == image.size
+
+
 def scaleSingleFrame(
     image,
     width,
@@ -178,35 +442,369 @@ def scaleSingleFrame(
     quality,  # not used, but here for backwards compatibility
     direction,
     resample=RESAMPLE,
+    instrument=None,
 ):
+    if instrument is None:
+        instrument = NULL_INSTRUMENT
     image = scalePILImage(
-        image, width, height, mode, direction=direction, resample=resample
+        image,
+        width,
+        height,
+        mode,
+        direction=direction,
+        resample=resample,
+        instrument=instrument,
     )
+    return _simplify_mode(image, format_, instrument)
+
+
+def _srgb_profile():
+    global SRGB_PROFILE
+    if SRGB_PROFILE is None:
+        SRGB_PROFILE = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB"))
+    return SRGB_PROFILE
 
-    # convert to simpler mode if possible
-    colors = image.getcolors(maxcolors=256)
-    if colors:
-        if image.mode in ("RGB", "RGBA") and format_ == "JPEG":
-            # check if it's all grey
-            if all(rgb[0] == rgb[1] == rgb[2] for c, rgb in colors):
-                image = image.convert("L")
-        elif image.mode not in ("P", "L", "LA") and format_ in ("PNG", "GIF"):
-            image = image.convert("P")
-
-    if image.mode == "RGBA" and format_ == "JPEG":
-        extrema = dict(zip(image.getbands(), image.getextrema()))
-        if extrema.get("A") == (255, 255):
-            # no alpha used, just change the mode, which causes the alpha band
-            # to be dropped on save
-            image = image.convert("RGB")
-        else:
-            # switch to PNG, which supports alpha
-            format_ = "PNG"
+
+def _is_srgb(profile):
+    """Does an RGB profile give the same colors as sRGB?
+
+    Descriptions are not reliable: "Linear sRGB" is not sRGB.  So we convert
+    a cube of sample colors to sRGB and check that they stay the same.
+    """
+    if profile.profile.xcolor_space.strip() != "RGB":
+        return False
+    levels = range(0, 256, 51)
+    sample = PIL.Image.frombytes(
+        "RGB",
+        (len(levels) ** 3, 1),
+        bytes(v for r in levels for g in levels for b in levels for v in (r, g, b)),
+    )
+    converted = ImageCms.profileToProfile(sample, profile, _srgb_profile())
+    return all(
+        abs(a - b) <= SRGB_TOLERANCE
+        for a, b in zip(sample.tobytes(), converted.tobytes())
+    )
+
+
+def _to_srgb(image, icc_profile, instrument=NULL_INSTRUMENT):
+    """Convert an image from its ICC profile to sRGB.
+
+    Returns the image and the profile to embed: None for sRGB.  When the
+    image cannot be converted, it is returned unchanged with its profile.
+    """
+    if ImageCms is None:
+        return image, icc_profile
+    if image.mode == "CMYK":
+        output_mode = "RGB"
+    elif image.mode in ("RGB", "RGBA"):
+        output_mode = image.mode
+    else:
+        return image, icc_profile
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        if _is_srgb(profile):
+            # Already sRGB, so the profile can simply be left out.
+            return image, None
+        with instrument.stage(
+            "color", mode=image.mode, pixels=image.width * image.height
+        ):
+            image = ImageCms.profileToProfile(
+                image, profile, _srgb_profile(), outputMode=output_mode
+            )
+    except (ImageCms.PyCMSError, OSError, ValueError):
+        logger.warning("Could not convert image with ICC profile to sRGB.")
+        return image, icc_profile
+    return image, None
+
+
+def _simplify_mode(image, format_, instrument=NULL_INSTRUMENT):
+    """Convert the image to a simpler mode if possible, for a smaller file.
+
+    Returns the image and the format, which is PNG instead of JPEG when the
+    image has transparency.
+    """
+    with instrument.stage("analyse", pixels=image.width * image.height):
+        # convert to simpler mode if possible
+        colors = image.getcolors(maxcolors=256)
+        if colors:
+            if image.mode in ("RGB", "RGBA") and format_ == "JPEG":
+                # check if it's all grey
+                if all(rgb[0] == rgb[1] == rgb[2] for c, rgb in colors):
+                    image = image.convert("L")
+            elif image.mode not in ("P", "L", "LA") and format_ in ("PNG", "GIF"):
+                image = image.convert("P")
+
+        if image.mode in ("RGBA", "LA") and format_ == "JPEG":
+            extrema = dict(zip(image.getbands(), image.getextrema()))
+            if extrema.get("A") == (255, 255):
+                # no alpha used, just change the mode, which causes the alpha band
+                # to be dropped on save
+                image = image.convert(image.mode[:-1])
+            else:
+                # switch to PNG, which supports alpha
+                format_ = "PNG"
 
     return image, format_
 
 
-def _scale_thumbnail(image, width=None, height=None, resample=RESAMPLE):
+def _raw_strips(image):
+    """Return the uncompressed, full width strips of an unloaded image.
+
+    Returns a list of (top, bottom, offset, rawmode, stride, ystep),
+    or None when the image data is not stored like this.
+    """
+    strips = []
+    for tile in getattr(image, "tile", None) or ():
+        codec, extents, offset, args = tile[:4]
+        if codec != "raw" or extents[0] != 0 or extents[2] != image.width:
+            return None
+        if isinstance(args, str):
+            args = (args,)
+        rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+        if not stride:
+            try:
+                row = PIL.Image.new(image.mode, (image.width, 1))
+                stride = len(row.tobytes("raw", rawmode))
+            except ValueError:
+                return None
+        strips.append((extents[1], extents[3], offset, rawmode, stride, ystep))
+    return sorted(strips) or None
+
+
+def _band_reduce(image, factor):
+    """Reduce an unloaded image by an integer factor, reading it in bands.
+
+    Only the current band of the original is in memory at any time.
+    Returns None when the image cannot be read in bands.
+    """
+    if image.mode not in ("L", "RGB", "CMYK") or factor < 2:
+        return None
+    strips = _raw_strips(image)
+    if strips is None:
+        return None
+    width, height = image.size
+    stride = max(strip[4] for strip in strips)
+    # Bands must be a multiple of the factor, so they reduce without seams.
+    rows = max(factor, BAND_BYTES // stride // factor * factor)
+    reduced = PIL.Image.new(
+        image.mode, (math.ceil(width / factor), math.ceil(height / factor))
+    )
+    for band_top in range(0, height, rows):
+        band_bottom = min(height, band_top + rows)
+        band = PIL.Image.new(image.mode, (width, band_bottom - band_top))
+        for top, bottom, offset, rawmode, stride, ystep in strips:
+            part_top = max(top, band_top)
+            part_bottom = min(bottom, band_bottom)
+            if part_top >= part_bottom:
+                continue
+            if ystep < 0:
+                # rows are stored bottom up
+                image.fp.seek(offset + (bottom - part_bottom) * stride)
+            else:
+                image.fp.seek(offset + (part_top - top) * stride)
+            data = image.fp.read((part_bottom - part_top) * stride)
+            part = PIL.Image.frombytes(
+                image.mode,
+                (width, part_bottom - part_top),
+                data,
+                "raw",
+                rawmode,
+                stride,
+                ystep,
+            )
+            band.paste(part, (0, part_top - band_top))
+        reduced.paste(band.reduce(factor), (0, band_top // factor))
+    reduced.info = image.info
+    return reduced
+
+
+def _band_reduce_for(image, width, height, mode, direction):
+    """Reduce a very large image for scaling to the given size.
+
+    The reduced image stays at least twice as large as the target, so the
+    final resampling keeps its quality.  Returns the reduced image, the box
+    of it to scale and the final size, which is the same as for the original
+    image.  Returns None when the image cannot or need not be reduced.
+    """
+    mode = get_scale_mode(mode, direction)
+    dimensions = _calculate_all_dimensions(
+        image.width, image.height, width, height, mode
+    )
+    size = (dimensions.final_width, dimensions.final_height)
+    if not size[0] or not size[1]:
+        return None
+    factor = int(min(image.width / (2 * size[0]), image.height / (2 * size[1])))
+    reduced = _band_reduce(image, factor)
+    if reduced is None:
+        return None
+    logger.debug(f"Reduced {image.size} image by {factor} to {reduced.size}")
+    # The reduced image may have a partial last row or column, so scale the
+    # part that corresponds to the box of the original.
+    box = _clamp_box(
+        [value / factor for value in dimensions.source_box],
+        reduced.width,
+        reduced.height,
+    )
+    return reduced, box, size
+
+
+def _draft_for(image, width, height, mode, direction):
+    """Set a JPEG image to draft mode for scaling to the given size.
+
+    Returns the image, the box of it to scale and the final size, which is
+    the same as for the full image.  Returns None when draft mode does not
+    reduce the image.
+    """
+    mode = get_scale_mode(mode, direction)
+    dimensions = _calculate_all_dimensions(
+        image.width, image.height, width, height, mode
+    )
+    size = (dimensions.final_width, dimensions.final_height)
+    if not size[0] or not size[1]:
+        return None
+    original_size = image.size
+    box = _draft(image, size, dimensions.source_box)
+    if image.size == original_size:
+        return None
+    return image, box, size
+
+
+def _reducing_gap(pixels, resample):
+    if resample == NEAREST or pixels <= REDUCING_MIN_PIXELS:
+        # With NEAREST, reducing would mix colors, which it is used to avoid.
+        return None
+    return REDUCING_GAP
+
+
+def _resize(image, size, resample):
+    return image.resize(
+        size, resample, reducing_gap=_reducing_gap(image.width * image.height, resample)
+    )
+
+
+def _converted_mode(image):
+    """Return the mode an image must have to be resampled, or None if its
+    current mode is fine."""
+    if image.mode == "1":
+        # Convert black&white to grayscale
+        return "L"
+    if image.mode == "P":
+        # If palette is grayscale, convert to gray+alpha
+        # Else convert palette based images to 3x8bit+alpha
+        palette = image.getpalette()
+        if palette[0::3] == palette[1::3] == palette[2::3]:
+            return "LA"
+        return "RGBA"
+    if image.mode == "CMYK":
+        # Convert CMYK to RGB, allowing for web previews of print images
+        return "RGB"
+    return None
+
+
+def _load(image, instrument=NULL_INSTRUMENT):
+    """Decode the image data, if this has not been done yet."""
+    if getattr(image, "tile", None):
+        with instrument.stage("decode"):
+            image.load()
+    else:
+        image.load()
+
+
+def _convert(image, instrument=NULL_INSTRUMENT):
+    """Convert "1", "P" and "CMYK" images to a mode that can be resampled.
+
+    Converting is expensive for big images, so call this as late as possible:
+    after decoding in draft mode and after cropping, which both give the same
+    result before or after the conversion.
+    """
+    if image.mode not in ("1", "P", "CMYK"):
+        return image
+    _load(image, instrument)
+    with instrument.stage(
+        "convert", mode=image.mode, pixels=image.width * image.height
+    ):
+        return image.convert(_converted_mode(image))
+
+
+def _convert_before_resize(image, resample, instrument=NULL_INSTRUMENT):
+    if resample == NEAREST:
+        # Picking pixels gives the same result before or after converting,
+        # so convert the smaller, resized image.
+        return image
+    return _convert(image, instrument)
+
+
+def _draft(image, size, box):
+    """Set a JPEG image to draft mode for scaling the `box` part to `size`.
+
+    It is then decoded at a reduced scale that still gives at least `size`
+    pixels for the box.  Returns the box in the coordinates of the reduced
+    image.
+    """
+    width, height = image.size
+    left, top, right, bottom = box
+    image.draft(
+        image.mode,
+        (
+            math.ceil(size[0] * width / (right - left)),
+            math.ceil(size[1] * height / (bottom - top)),
+        ),
+    )
+    if image.size == (width, height):
+        return box
+    factor_width = image.width / width
+    factor_height = image.height / height
+    return _clamp_box(
+        (
+            left * factor_width,
+            top * factor_height,
+            right * factor_width,
+            bottom * factor_height,
+        ),
+        image.width,
+        image.height,
+    )
+
+
+def _crop_resize(image, size, box, resample, instrument=NULL_INSTRUMENT):
+    """Resample the `box` part of the image to `size` in a single step.
+
+    The box can have fractions of pixels.  JPEG images are first set to draft
+    mode, so they are decoded at a reduced scale that still gives at least
+    `size` pixels for the box.
+    """
+    if not size[0] or not size[1]:
+        raise ValueError("height and width must be > 0")
+    left, top, right, bottom = _draft(image, size, box)
+    _load(image, instrument)
+    if resample != NEAREST and _converted_mode(image) is not None:
+        # Only convert the pixels inside the box.
+        crop = (
+            int(math.floor(left)),
+            int(math.floor(top)),
+            min(int(math.ceil(right)), image.width),
+            min(int(math.ceil(bottom)), image.height),
+        )
+        image = _convert(image.crop(crop), instrument)
+        left, right = left - crop[0], right - crop[0]
+        top, bottom = top - crop[1], bottom - crop[1]
+    with instrument.stage(
+        "resize",
+        source_pixels=int((right - left) * (bottom - top)),
+        target_pixels=size[0] * size[1],
+    ):
+        image = image.resize(
+            size,
+            resample,
+            box=(left, top, right, bottom),
+            reducing_gap=_reducing_gap((right - left) * (bottom - top), resample),
+        )
+    return _convert(image, instrument)
+
+
+def _scale_thumbnail(
+    image, width=None, height=None, resample=RESAMPLE, instrument=NULL_INSTRUMENT
+):
     """Scale with method "thumbnail".
 
     Aspect Ratio is kept. Resulting image has to fit in the given box.
@@ -220,11 +818,20 @@ def _scale_thumbnail(image, width=None, height=None, resample=RESAMPLE):
     if (dimensions.target_width * dimensions.target_height) > MAX_PIXELS:
         # The new image would be excessively large and eat up all memory while
         # scaling, so return the potentially pre cropped image
-        return image
+        return _convert(image, instrument)
 
     image.draft(image.mode, (dimensions.target_width, dimensions.target_height))
-    image = image.resize((dimensions.target_width, dimensions.target_height), resample)
-    return image
+    _load(image, instrument)
+    image = _convert_before_resize(image, resample, instrument)
+    with instrument.stage(
+        "resize",
+        source_pixels=image.width * image.height,
+        target_pixels=dimensions.target_width * dimensions.target_height,
+    ):
+        image = _resize(
+            image, (dimensions.target_width, dimensions.target_height), resample
+        )
+    return _convert(image, instrument)
 
 
 def get_scale_mode(mode, direction=None):
@@ -252,6 +859,8 @@ class ScaledDimensions:
         self.factor_width = self.factor_height = 1.0
         self.post_scale_crop = False
         self.pre_scale_crop = False
+        # The part of the original that is scaled to the final size.
+        self.source_box = (0, 0, original_width, original_height)
 
 
 def _calculate_all_dimensions(
@@ -410,9 +1019,45 @@ def _calculate_all_dimensions(
             dimensions.final_width = right - left
         dimensions.post_scale_crop = (left, top, right, bottom)
 
+    if not dimensions.final_width or not dimensions.final_height:
+        # Nothing to scale to: Pillow raises an error for this.
+        return dimensions
+
+    # The centered part of the original with the aspect ratio of the final
+    # size, without rounding.  Scaling it gives the same result as cropping
+    # before and after scaling.
+    factor = min(
+        original_width / dimensions.final_width,
+        original_height / dimensions.final_height,
+    )
+    box_width = dimensions.final_width * factor
+    box_height = dimensions.final_height * factor
+    left = (original_width - box_width) / 2.0
+    top = (original_height - box_height) / 2.0
+    dimensions.source_box = _clamp_box(
+        (left, top, left + box_width, top + box_height),
+        original_width,
+        original_height,
+    )
+
     return dimensions
 
 
+def _clamp_box(box, width, height):
+    """Keep a box inside an image of the given size.
+
+    Rounding errors of float calculations can put the box slightly outside,
+    for which Pillow raises an error.
+    """
+    left, top, right, bottom = box
+    return (
+        max(0.0, left),
+        max(0.0, top),
+        min(float(width), right),
+        min(float(height), bottom),
+    )
+
+
 def calculate_scaled_dimensions(
     original_width, original_height, width, height, mode="scale"
 ):
@@ -425,8 +1070,79 @@ def calculate_scaled_dimensions(
     return (dimensions.final_width, dimensions.final_height)
 
 
+def plan_srcset(
+    original_width,
+    original_height,
+    candidates,
+    height=None,
+    mode="scale",
+    threshold=0.1,
+):
+    """Plan which scales of an image are worth generating for a srcset.
+
+    `candidates` is a list of widths, or of dicts with scale parameters
+    (`width`, `height`, `mode` or the deprecated `direction`).  For plain
+    widths, `height` and `mode` are used.
+
+    Candidates that would upscale the original are left out, unless none are
+    left.  So are candidates with the same final dimensions as a bigger
+    candidate, or with at most `threshold` times fewer pixels.
+
+    Returns a list of ``(parameters, (width, height))`` tuples, sorted by
+    number of pixels, smallest first, with the final dimensions as
+    calculated by :func:`calculate_scaled_dimensions`.
+    """
+    planned = []
+    for candidate in candidates:
+        if isinstance(candidate, dict):
+            parameters = dict(candidate)
+        else:
+            parameters = dict(width=candidate)
+            if height is not None:
+                parameters["height"] = height
+            if mode != "scale":
+                parameters["mode"] = mode
+        size = calculate_scaled_dimensions(
+            original_width,
+            original_height,
+            parameters.get("width"),
+            parameters.get("height"),
+            get_scale_mode(parameters.get("mode"), parameters.get("direction")),
+        )
+        planned.append((parameters, size))
+    if not planned:
+        return []
+    # Start with the biggest, so they win from smaller ones that are
+    # almost the same.
+    planned.sort(key=lambda item: (item[1][0] * item[1][1], item[1]), reverse=True)
+    result = [
+        item
+        for item in planned
+        if item[1][0] <= original_width and item[1][1] <= original_height
+    ]
+    if not result:
+        # Only upscaling candidates: keep the smallest.
+        result = planned[-1:]
+    kept = []
+    for parameters, size in result:
+        if kept:
+            pixels = size[0] * size[1]
+            previous = kept[-1][1]
+            if pixels * (1 + threshold) >= previous[0] * previous[1]:
+                continue
+        kept.append((parameters, size))
+    kept.reverse()
+    return kept
+
+
 def scalePILImage(
-    image, width=None, height=None, mode="scale", direction=None, resample=RESAMPLE
+    image,
+    width=None,
+    height=None,
+    mode="scale",
+    direction=None,
+    resample=RESAMPLE,
+    instrument=None,
 ):
     """Scale a PIL image to another size.
 
@@ -460,6 +1176,9 @@ def scalePILImage(
     Use the `resample` parameter to set a resampling filter from PIL.Image.Resampling.
     The default is `LANCZOS` (or `ANTIALIAS` in older versions of PIL).
 
+    The optional `instrument` gets timings of the stages, see
+    :class:`plone.scale.instrument.ScaleInstrument`.
+
     The return value is the scaled image in the form of another instance of
     `PIL.Image`.
     """
@@ -473,24 +1192,11 @@ def scalePILImage(
 
     mode = get_scale_mode(mode, direction)
 
-    if image.mode == "1":
-        # Convert black&white to grayscale
-        image = image.convert("L")
-    elif image.mode == "P":
-        # If palette is grayscale, convert to gray+alpha
-        # Else convert palette based images to 3x8bit+alpha
-        palette = image.getpalette()
-        if palette[0::3] == palette[1::3] == palette[2::3]:
-            image = image.convert("LA")
-        else:
-            image = image.convert("RGBA")
-    elif image.mode == "CMYK":
-        # Convert CMYK to RGB, allowing for web previews of print images
-        image = image.convert("RGB")
-
+    if instrument is None:
+        instrument = NULL_INSTRUMENT
     # for scale we're done:
     if mode == "scale":
-        return _scale_thumbnail(image, width, height, resample)
+        return _scale_thumbnail(image, width, height, resample, instrument)
 
     dimensions = _calculate_all_dimensions(
         image.size[0], image.size[1], width, height, mode
@@ -499,29 +1205,40 @@ def scalePILImage(
     if dimensions.factor_height == dimensions.factor_width:
         # The original already has the right aspect ratio, so we only need
         # to scale.
-        if mode == "contain":
-            image.thumbnail((dimensions.final_width, dimensions.final_height), resample)
-            return image
-        return image.resize((dimensions.final_width, dimensions.final_height), resample)
-
-    if dimensions.pre_scale_crop:
-        # crop image before scaling to avoid excessive memory use
-        # in case the intermediate result would be very tall or wide
-        image = image.crop(dimensions.pre_scale_crop)
+        image.draft(image.mode, (dimensions.final_width, dimensions.final_height))
+        _load(image, instrument)
+        image = _convert_before_resize(image, resample, instrument)
+        with instrument.stage(
+            "resize",
+            source_pixels=image.width * image.height,
+            target_pixels=dimensions.final_width * dimensions.final_height,
+        ):
+            if mode == "contain":
+                # thumbnail already reduces in two steps by itself.
+                image.thumbnail(
+                    (dimensions.final_width, dimensions.final_height), resample
+                )
+            else:
+                image = _resize(
+                    image, (dimensions.final_width, dimensions.final_height), resample
+                )
+        return _convert(image, instrument)
 
     if (dimensions.target_width * dimensions.target_height) > MAX_PIXELS:
         # The new image would be excessively large and eat up all memory while
         # scaling, so return the potentially pre cropped image
-        return image
-
-    image.draft(image.mode, (dimensions.target_width, dimensions.target_height))
-    image = image.resize((dimensions.target_width, dimensions.target_height), resample)
-
-    if dimensions.post_scale_crop:
-        # crop off remains due to rounding before scaling
-        image = image.crop(dimensions.post_scale_crop)
-
-    return image
+        if dimensions.pre_scale_crop:
+            image = image.crop(dimensions.pre_scale_crop)
+        return _convert(image, instrument)
+
+    # Crop and resize in one step, straight to the final size.
+    return _crop_resize(
+        image,
+        (dimensions.final_width, dimensions.final_height),
+        dimensions.source_box,
+        resample,
+        instrument,
+    )
 
 
 def _contain_svg_image(root, target_width: int, target_height: int):
@@ -0,0 +1,74 @@
+import logging
+import threading
+
+logger = logging.getLogger("plone.scale")
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.shared = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Run a function only once for concurrent calls with the same key.
+
+    The first caller for a key runs the function.  Callers arriving while
+    it runs wait for it and get the same result, or the same exception.
+
+    This only works within one process.  Other processes cannot see the
+    result before it has been committed, so they generate it themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, share=None):
+        """Run ``func`` for ``key``, or wait for the concurrent call.
+
+        When ``share`` is given, waiting callers do not get the result
+        itself, but ``share(result)``.  This is called in the thread of the
+        first caller, and only when others are waiting.  Use it to give them
+        a result that is not tied to the first caller, like its database
+        connection.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+        if not leader:
+            logger.debug(f"Waiting for concurrent call for {key!r}")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.shared
+        try:
+            call.result = func()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.error is None and call.followers:
+                self._share(call, share)
+            call.event.set()
+        return call.result
+
+    def _share(self, call, share):
+        if share is None:
+            call.shared = call.result
+            return
+        try:
+            call.shared = share(call.result)
+        except Exception as error:
+            # The result is fine for the first caller, only not for others.
+            logger.exception("Could not share result of concurrent call")
+            call.error = error
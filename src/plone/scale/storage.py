@@ -1,17 +1,28 @@
+from .background import DEFAULT_PRIORITY
+from .background import ScaleJob
+from .metrics import get_sink
+from .metrics import timed
 from .scale import calculate_scaled_dimensions
 from .scale import get_scale_mode
+from .scale import MAX_HEIGHT
 from collections.abc import MutableMapping
+from persistent import Persistent
 from persistent.mapping import PersistentMapping
 from plone.scale.interfaces import IImageScaleFactory
+from time import perf_counter
 from time import time
 from ZODB.POSException import ConflictError
 from zope.annotation import IAnnotations
 from zope.interface import implementer
 from zope.interface import Interface
 
+import base64
 import hashlib
+import hmac
+import json
 import logging
 import pprint
+import transaction
 
 try:
     from plone.protect.utils import safeWrite
@@ -35,17 +46,46 @@ class IImageScaleStorage(Interface):
     existing image scales using the scale id as key. To find or create a
     scale based on its scaling parameters use the :meth:`scale` method."""
 
-    def __init__(context, modified=None):
+    def __init__(context, modified=None, cache=False):
         """Adapt the given context item and optionally provide a callable
         to return a representation of the last modification date, which
-        can be used to invalidate stored scale data on update."""
+        can be used to invalidate stored scale data on update.
 
-    def pre_scale(**parameters):
+        When ``cache`` is true, the modification date and the annotation
+        lookup are resolved only once per transaction."""
+
+    def pre_scale(priority=None, **parameters):
         """Pre-register a unique id for a scale, without actually scaling.
 
         In other words: no use of Pillow allowed.
+
+        When a background queue is configured, the scale is queued for
+        generation with the given ``priority``.  Lower numbers go first.
+        """
+
+    def pre_scale_many(parameters_list, priority=None):
+        """Pre-register unique ids for a list of parameter dicts.
+
+        Returns a list with the info (or None) for each parameter dict,
+        in the same order.  All new infos are stored in one write.
+
+        Parameters that give a scale with the same final dimensions as
+        another scale, for example all widths of a srcset that are bigger
+        than the original, get the info of that scale.  Their uid is stored
+        as an alias of it.
         """
 
+    def pre_scale_variants(output_formats, priority=None, **parameters):
+        """Pre-register a scale plus variants of it in other output formats.
+
+        Returns the info of the scale, with the uids of the variants by
+        mimetype in ``variants``.  These are also stored, unless a
+        ``signing_key`` is set.
+        """
+
+    def negotiate(info, accept):
+        """Return the info of the variant that fits an Accept header best."""
+
     def scale(**parameters):
         """Find image scale data for the given parameters or create it.
 
@@ -60,23 +100,167 @@ class IImageScaleStorage(Interface):
     def __getitem__(uid):
         """Find image scale data based on its uid."""
 
+    def get_data(uid):
+        """Return the data of a generated scale, or None.
+
+        With a ``data_cache``, this and ``get_or_generate`` serve the data
+        from memory when possible.
+        """
+
     def get_or_generate(uid):
         """Find image scale data based on its uid, or generate it.
 
         Only uids pre-generated by the pre_scale method should be accepted.
+        With a ``signing_key``, these are uids signed by pre_scale, which
+        contain the scale parameters instead of a stored placeholder.
 
         Outdated scales may be returned: this method is called when requesting a scale
         on a cached, unique url.  An old cached page may still point to this.
         """
 
 
+class ScaleData(Persistent):
+    """The data of a generated scale, stored as its own persistent object.
+
+    The ``ScalesDict`` only holds a reference, so looking up a scale or
+    registering a new one does not load the data of all scales.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+class ScaleInfo(dict):
+    """Info about a scale.
+
+    The ``data`` may be stored as :class:`ScaleData`.  It is only loaded when
+    the data is actually requested, also via ``items``, ``values`` or
+    unpacking with ``**info``.  ``copy`` and pickling keep it as is.
+    """
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if key == "data" and isinstance(value, ScaleData):
+            return value.data
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        # Overriding this makes ``dict(info)`` and ``**info`` use
+        # ``__getitem__`` instead of reading the stored values directly.
+        return super().__iter__()
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def copy(self):
+        return self.__class__(dict.items(self))
+
+    def __reduce__(self):
+        return self.__class__, (), None, None, iter(dict.items(self))
+
+
+def has_data(info):
+    """Has the scale of this info been generated?
+
+    This does not load the data.
+    """
+    return dict.get(info, "data") is not None
+
+
+def _detached(info):
+    """Return a copy of an info that does not refer to persistent objects.
+
+    The data is read as bytes.  This can be used outside of the database
+    connection of the info.
+    """
+    if info is None:
+        return None
+    detached = ScaleInfo((key, info[key]) for key in info)
+    data = detached.get("data")
+    if data is not None:
+        detached["data"] = getattr(data, "data", data)
+    return detached
+
+
+def _parse_accept(accept):
+    """Return the qualities of the media types in an Accept header.
+
+    Ranges with wildcards are left out.
+    """
+    accepted = {}
+    for media_range in (accept or "").split(","):
+        media_type, *params = media_range.split(";")
+        media_type = media_type.strip().lower()
+        if not media_type or "*" in media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type] = max(quality, accepted.get(media_type, 0))
+    return accepted
+
+
 class ScalesDict(PersistentMapping):
     def raise_conflict(self, saved, new):
         logger.info("Conflict")
+        get_sink().increment("conflict", result="raised")
         logger.debug("saved\n" + pprint.pformat(saved))
         logger.debug("new\n" + pprint.pformat(new))
         raise ConflictError
 
+    def equivalent(self, saved, new):
+        """Are these two infos for the same scale?
+
+        This is the case when both transactions registered or generated a
+        scale with the same parameters, for example two threads that generated
+        the same pre-registered scale at the same time.
+        """
+        if saved.get("key") != new.get("key"):
+            return False
+        if has_data(saved) and has_data(new):
+            # Both generated: they must be for the same modification time.
+            return saved["modified"] == new["modified"]
+        return True
+
+    def pick(self, saved, new):
+        """Pick one of two equivalent infos, preferring a generated scale.
+
+        Otherwise we keep the already committed one.  Variants registered
+        in only one of them are kept.
+        """
+        picked, other = saved, new
+        if not has_data(saved) and has_data(new):
+            picked, other = new, saved
+        if other.get("variants") and not picked.get("variants"):
+            picked = picked.copy()
+            picked["variants"] = other["variants"]
+        return picked
+
+    def changed(self, old, new):
+        """Has an info changed?
+
+        A new modification time means a new scale or placeholder.  Variants
+        are added to an info without changing its modification time.
+        """
+        return old["modified"] != new["modified"] or old.get("variants") != new.get(
+            "variants"
+        )
+
+    @timed("conflict")
     def _p_resolveConflict(self, oldState, savedState, newState):
         logger.debug("Resolve conflict")
         old = oldState["data"]
@@ -88,7 +272,7 @@ class ScalesDict(PersistentMapping):
         for key, value in new.items():
             if key not in old:
                 added.append(key)
-            elif value["modified"] != old[key]["modified"]:
+            elif self.changed(old[key], value):
                 modified.append(key)
             # else:
             # unchanged
@@ -97,7 +281,7 @@ class ScalesDict(PersistentMapping):
                 deleted.append(key)
         for key in deleted:
             if key in saved:
-                if old[key]["modified"] == saved[key]["modified"]:
+                if not self.changed(old[key], saved[key]):
                     # unchanged by saved, deleted by new
                     logger.debug("deleted %s" % repr(key))
                     del saved[key]
@@ -107,7 +291,10 @@ class ScalesDict(PersistentMapping):
         for key in added:
             if key in saved:
                 # added by saved, added by new
-                self.raise_conflict(saved[key], new[key])
+                if not self.equivalent(saved[key], new[key]):
+                    self.raise_conflict(saved[key], new[key])
+                logger.debug("added equivalent %s" % repr(key))
+                saved[key] = self.pick(saved[key], new[key])
             else:
                 # not in saved, added by new
                 logger.debug("added %s" % repr(key))
@@ -116,13 +303,17 @@ class ScalesDict(PersistentMapping):
             if key not in saved:
                 # deleted by saved, modified by new
                 self.raise_conflict(key, new[key])
-            elif saved[key]["modified"] != old[key]["modified"]:
+            elif self.changed(old[key], saved[key]):
                 # modified by saved, modified by new
-                self.raise_conflict(saved[key], new[key])
+                if not self.equivalent(saved[key], new[key]):
+                    self.raise_conflict(saved[key], new[key])
+                logger.debug("modified equivalent %s" % repr(key))
+                saved[key] = self.pick(saved[key], new[key])
             else:
                 # unchanged in saved, modified by new
                 logger.debug("modified %s" % repr(key))
                 saved[key] = new[key]
+        get_sink().increment("conflict", result="resolved")
         return dict(data=saved)
 
 
@@ -133,9 +324,61 @@ class AnnotationStorage(MutableMapping):
     annotation on the object container, i.e. the image. This is needed
     since not all images are themselves annotatable."""
 
-    def __init__(self, context, modified=None):
+    # Secret (bytes or str) used to sign self-describing uids.  When set,
+    # pre_scale does not store placeholder infos: the scale parameters are
+    # encoded in the uid, so get_or_generate can reconstruct them and page
+    # rendering does not write to the database.
+    signing_key = None
+
+    # A plone.scale.singleflight.SingleFlight instance shared by all storages
+    # in the process.  When set, concurrent get_or_generate calls for the same
+    # scale only generate it once.  The other callers get a copy of the info
+    # with the data as bytes, because the stored data belongs to the database
+    # connection of the thread that generated it.
+    single_flight = None
+
+    # A plone.scale.background.ScaleQueue.  When set, pre-registered scales
+    # are queued for generation in the background after the transaction
+    # has been committed.
+    queue = None
+
+    # Maximum age in milliseconds of an outdated scale that ``scale`` may
+    # still return, relative to the modification time.  The scale is then
+    # regenerated by the background queue.  None: always regenerate inline.
+    max_staleness = None
+
+    # A plone.scale.bytecache.ScaleDataCache shared by all storages in the
+    # process.  When set, get_data and get_or_generate serve the data of
+    # popular scales from memory.  scale only uses already cached data.
+    data_cache = None
+
+    def __init__(self, context, modified=None, cache=False):
         self.context = context
         self.modified = modified
+        # When cache is true, the modification time and the annotation
+        # lookup are only resolved once per transaction.
+        self.cache = cache
+        self._cache = {}
+        self._cache_transaction = None
+        # fieldname -> (modification time, version of the original image)
+        self._versions = {}
+
+    def _cached(self, key, func):
+        if not self.cache:
+            return func()
+        current = transaction.get()
+        if current is not self._cache_transaction:
+            self._cache = {}
+            self._cache_transaction = current
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = func()
+            return value
+
+    def invalidate_cache(self):
+        """Forget all values cached for the current transaction."""
+        self._cache = {}
 
     def _modified_since(self, since, offset=0):
         # offset gets subtracted from the main modified time: this allows to
@@ -156,12 +399,62 @@ class AnnotationStorage(MutableMapping):
         modified_time = modified_time - offset
         return modified_time > since
 
+    def original_version(self, fieldname=None):
+        """Return the version of the original image, if the factory knows it.
+
+        This is the result of the optional ``get_original_version`` method
+        of the ``IImageScaleFactory``, for example a digest of the image.
+        It is only asked again when the modification time changes, because
+        a new image also modifies the content item.
+        """
+        modified_time = self.modified_time
+        try:
+            version_modified, version = self._versions[fieldname]
+        except KeyError:
+            pass
+        else:
+            if version_modified == modified_time:
+                return version
+        scaling_factory = IImageScaleFactory(self.context, None)
+        get_version = getattr(scaling_factory, "get_original_version", None)
+        if get_version is None:
+            version = None
+        else:
+            version = get_version(fieldname=fieldname)
+        self._versions[fieldname] = (modified_time, version)
+        return version
+
+    def _current_version(self, info):
+        version = info.get("version")
+        if version is None:
+            return False
+        return version == self.original_version(info.get("fieldname"))
+
+    def _outdated(self, info):
+        # Scales made from a known version of the original image stay valid
+        # as long as the image does not change, even when the content item
+        # itself is modified.
+        if info.get("version") is not None:
+            return not self._current_version(info)
+        return self._modified_since(info["modified"])
+
     @property
     def modified_time(self):
-        if self.modified is not None:
-            return self.modified()
-        else:
+        if self.modified is None:
             return None
+        # Key on the callable as well: it may be replaced on the instance.
+        return self._cached(("modified", self.modified), self.modified)
+
+    @property
+    def context_key(self):
+        """Identify our context outside of the current transaction.
+
+        This is the database oid, or the object id when not persistent.
+        """
+        oid = getattr(self.context, "_p_oid", None)
+        if oid is None:
+            return id(self.context)
+        return oid
 
     def __repr__(self):
         name = self.__class__.__name__
@@ -171,6 +464,25 @@ class AnnotationStorage(MutableMapping):
 
     @property
     def storage(self):
+        return self._cached("storage", self._get_storage)
+
+    @property
+    def _scales(self):
+        """The stored scales, for reading.
+
+        Unlike ``storage`` this does not create or migrate the storage, so
+        looking up scales does not write to the database.  Without stored
+        scales this is an empty dict.
+        """
+        scales = self._cached("scales", self._get_scales)
+        if scales is None:
+            return {}
+        return scales
+
+    def _get_scales(self):
+        return IAnnotations(self.context).get("plone.scale")
+
+    def _get_storage(self):
         annotations = IAnnotations(self.context)
         if "plone.scale" not in annotations:
             annotations["plone.scale"] = ScalesDict()
@@ -193,78 +505,381 @@ class AnnotationStorage(MutableMapping):
         return dict(hash_key)
 
     def get_info_by_hash(self, hash):
-        for value in self.storage.values():
+        for value in self._scales.values():
             if value["key"] == hash:
                 return value
 
+    def _get_info_by_canonical(self, parameters):
+        """Find an info stored with another spelling of the parameters."""
+        canonical = self.canonical_parameters(**parameters)
+        for value in self._scales.values():
+            try:
+                stored = self.unhash(value["key"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if self.canonical_parameters(**stored) == canonical:
+                return value
+
+    def canonical_parameters(self, **parameters):
+        """Return the parameters in a canonical form.
+
+        Parameters that give the same scale get the same form, so they share
+        one stored scale: the mode is one of the modes of ``get_scale_mode``
+        (left out for the default "scale"), and a width or height that is
+        ignored by the scaling is left out.
+        """
+        parameters.pop("modified", None)
+        if "direction" in parameters or "mode" in parameters:
+            mode = parameters.pop("direction", None)
+            if mode is None:
+                mode = parameters.get("mode")
+            mode = get_scale_mode(mode)
+            if mode == "scale":
+                parameters.pop("mode", None)
+            else:
+                parameters["mode"] = mode
+        width = parameters.get("width")
+        if isinstance(width, number_types) and width <= 0:
+            width = None
+        if width is None:
+            parameters.pop("width", None)
+        height = parameters.get("height")
+        if isinstance(height, number_types) and (height <= 0 or height >= MAX_HEIGHT):
+            height = None
+        if height is None:
+            parameters.pop("height", None)
+        output_format = parameters.get("output_format")
+        if isinstance(output_format, str):
+            output_format = output_format.upper()
+            if output_format == "JPG":
+                output_format = "JPEG"
+            parameters["output_format"] = output_format
+        return parameters
+
     def hash_key(self, **parameters):
+        return self._hash_key(self.canonical_parameters(**parameters))
+
+    def _hash_key(self, parameters):
         if "modified" in parameters:
             del parameters["modified"]
         fieldname = parameters.get("fieldname", "image")
         dimension = parameters.get("width", parameters.get("scale"))
         if dimension is None:
             dimension = 0
+        if self.signing_key is not None:
+            return self._signed_uid(f"{fieldname}-{dimension}", parameters)
         if (
             "scale" in parameters
             and parameters.get("width")
             and parameters.get("height")
         ):
             del parameters["scale"]
-        key = self.hash(modified=self.modified_time, **parameters)
+        version = self.original_version(parameters.get("fieldname"))
+        if version is not None:
+            key = self.hash(version=version, **parameters)
+        else:
+            key = self.hash(modified=self.modified_time, **parameters)
         hash_key = hashlib.md5(str(key).encode("utf-8")).hexdigest()
         # We return a uid that is recognizable when you inspect a url in html or
         # on the network tab: you immediately see for which field this is and what
         # the width is.  This helps during debugging/testing.
         return f"{fieldname}-{dimension}-{hash_key}"
 
-    def pre_scale(self, **parameters):
+    def _get_legacy(self, parameters):
+        """Get the info stored with the uid of the parameters as given.
+
+        Before the parameters were made canonical, this was their uid.
+        """
+        if self.signing_key is not None:
+            return
+        uid = self._hash_key(dict(parameters))
+        if uid != self.hash_key(**parameters):
+            return self.get(uid)
+
+    def _signature(self, payload):
+        signing_key = self.signing_key
+        if isinstance(signing_key, str):
+            signing_key = signing_key.encode("utf-8")
+        return hmac.new(signing_key, payload, hashlib.sha256).hexdigest()[:32]
+
+    def _signed_uid(self, prefix, parameters):
+        # The payload contains the complete parameters, plus the version or
+        # modification time so the uid changes when the image changes.
+        # base32 is used because it does not contain the "-" separator and is
+        # url safe.
+        version = self.original_version(parameters.get("fieldname"))
+        if version is not None:
+            basis = dict(p=parameters, v=version)
+        else:
+            basis = dict(p=parameters, m=self.modified_time)
+        payload = json.dumps(
+            basis,
+            sort_keys=True,
+            separators=(",", ":"),
+            default=repr,
+        ).encode("utf-8")
+        payload = base64.b32encode(payload).decode("ascii").rstrip("=").lower()
+        signature = self._signature(payload.encode("ascii"))
+        return f"{prefix}-{signature}-{payload}"
+
+    def parameters_from_uid(self, uid):
+        """Return the scale parameters encoded in a signed uid.
+
+        Returns None when signing is not enabled, or when the uid was not
+        signed with our key.
+        """
+        if self.signing_key is None or not isinstance(uid, str):
+            return
+        parts = uid.rsplit("-", 2)
+        if len(parts) != 3:
+            return
+        signature, payload = (part.encode("ascii", "replace") for part in parts[1:])
+        if not hmac.compare_digest(signature, self._signature(payload).encode("ascii")):
+            return
+        try:
+            payload = base64.b32decode(payload.upper() + b"=" * (-len(payload) % 8))
+            parameters = json.loads(payload)["p"]
+        except (ValueError, TypeError, KeyError):
+            return
+        if not isinstance(parameters, dict):
+            return
+        return parameters
+
+    def pre_scale(self, priority=None, **parameters):
         # This does *not* create a scale.
         # It only prepares info.
-        logger.debug(f"Pre scale {parameters}")
-        uid = self.hash_key(**parameters)
-        # self.clear()
-        # logger.debug(list(self.storage.keys()))
-        info = self.get(uid)
-        if info is not None and not self._modified_since(info["modified"]):
-            logger.debug(f"Pre scale returns old {info}")
-            return info
+        return self.pre_scale_many([parameters], priority=priority)[0]
+
+    @timed("pre_scale")
+    def pre_scale_many(self, parameters_list, priority=None):
+        # Like pre_scale, but for a list of parameter dicts, for example all
+        # scales of a srcset.  The original image is looked up once per
+        # fieldname and all new infos are written in a single update.
+        logger.debug(f"Pre scale many {parameters_list}")
+        infos = [None] * len(parameters_list)
+        missing = []
+        jobs = []
+        for index, parameters in enumerate(parameters_list):
+            uid = self.hash_key(**parameters)
+            info = self.get(uid)
+            if info is None:
+                info = self._get_legacy(parameters)
+            if info is not None:
+                info = self._resolve(info)
+            if info is not None and not self._outdated(info):
+                logger.debug(f"Pre scale returns old {info}")
+                infos[index] = info
+            else:
+                missing.append((index, uid, parameters))
+        metrics = get_sink()
+        metrics.increment(
+            "pre_scale", len(parameters_list) - len(missing), result="reused"
+        )
+        metrics.increment("pre_scale", len(missing), result="new")
+        if not missing:
+            return infos
 
         scaling_factory = IImageScaleFactory(self.context, None)
         if scaling_factory is None:
             # There is nothing we can do.
+            return infos
+        originals = {}
+        new_infos = {}
+        # uid -> info returned for it
+        results = {}
+        targets = self._alias_targets()
+        modified = int(time() * 1000)
+        for index, uid, parameters in missing:
+            if uid in results:
+                infos[index] = results[uid]
+                continue
+            fieldname = parameters.get("fieldname", None)
+            if fieldname not in originals:
+                value = scaling_factory.get_original_value(fieldname=fieldname)
+                # Either an empty value, or the field does not exist.
+                size = value.getImageSize() if value is not None else None
+                originals[fieldname] = (value, size)
+            value, size = originals[fieldname]
+            if value is None:
+                continue
+
+            # There is no info, or it is outdated.  Recreate the scale info.
+            # We need width and height for various reasons.
+            # Start with a basis.
+            orig_width, orig_height = size
+            mode = get_scale_mode(parameters.get("mode"), parameters.get("direction"))
+            width, height = calculate_scaled_dimensions(
+                orig_width,
+                orig_height,
+                parameters.get("width"),
+                parameters.get("height"),
+                mode,
+            )
+            canonical = self.canonical_parameters(**parameters)
+            mimetype = value.contentType
+            if canonical.get("output_format"):
+                mimetype = f"image/{canonical['output_format'].lower()}"
+            info = ScaleInfo(
+                uid=uid,
+                key=self.hash(**parameters),
+                modified=modified,
+                mimetype=mimetype,
+                data=None,
+                width=width,
+                height=height,
+            )
+            if fieldname:
+                info["fieldname"] = fieldname
+            version = self.original_version(fieldname)
+            if version is not None:
+                info["version"] = version
+            output_key = self._output_key(parameters, width, height)
+            target = targets.get(output_key)
+            if target is not None:
+                # The same scale is already known under another uid.
+                info["alias"] = target["uid"]
+                new_infos[uid] = info
+                results[uid] = infos[index] = target
+                logger.debug(f"Pre scale returns {target} for alias {uid}")
+                continue
+            targets[output_key] = info
+            new_infos[uid] = info
+            results[uid] = infos[index] = info
+            if self.queue is not None:
+                jobs.append(
+                    ScaleJob(
+                        self.context_key,
+                        uid,
+                        parameters,
+                        DEFAULT_PRIORITY if priority is None else priority,
+                    )
+                )
+            logger.debug(f"Pre scale returns new {info}")
+        if new_infos and self.signing_key is None:
+            self._store(new_infos)
+        if jobs:
+            # Workers can only see our placeholders after the commit.
+            transaction.get().addAfterCommitHook(self._queue_jobs, args=(jobs,))
+        return infos
+
+    def _output_key(self, parameters, width, height):
+        """Return a key that is the same for scales with the same output.
+
+        These are scales with the same final dimensions, mode and other
+        parameters, like the quality.
+        """
+        parameters = self.canonical_parameters(**parameters)
+        for name in ("width", "height", "scale"):
+            parameters.pop(name, None)
+        return self.hash(**parameters), width, height
+
+    def _alias_targets(self):
+        # Map the output key to the info of the stored scales that are
+        # current, so other uids can be stored as alias of them.
+        targets = {}
+        if self.signing_key is not None:
+            return targets
+        for info in self._scales.values():
+            if info.get("alias") is not None or self._outdated(info):
+                continue
+            try:
+                parameters = self.unhash(info["key"])
+            except (KeyError, TypeError, ValueError):
+                # For example old scales that were stored by a uuid4 key.
+                continue
+            output_key = self._output_key(
+                parameters, info.get("width"), info.get("height")
+            )
+            targets.setdefault(output_key, info)
+        return targets
+
+    def _resolve(self, info):
+        """Return the info of the scale an alias points to.
+
+        Other infos are returned as is.  Returns None when the scale of the
+        alias no longer exists.
+        """
+        alias = info.get("alias")
+        if alias is None:
+            return info
+        return self.get(alias)
+
+    def pre_scale_variants(self, output_formats, priority=None, **parameters):
+        """Pre-register a scale plus variants of it in other output formats.
+
+        The variants are registered with an extra ``output_format``
+        parameter, which the image scale factory should pass on to
+        ``scaleImage``.  Their uids are stored in the ``variants`` of the
+        info of the scale, by mimetype, so ``negotiate`` can pick one.
+
+        With a ``signing_key`` nothing is stored, so only the returned info
+        has the variants.  Negotiate with that info when rendering the page,
+        because the info of the scale that is generated later has none.
+        """
+        parameters_list = [parameters]
+        for output_format in output_formats:
+            parameters_list.append(dict(parameters, output_format=output_format))
+        infos = self.pre_scale_many(parameters_list, priority=priority)
+        info = infos[0]
+        if info is None:
             return
-        fieldname = parameters.get("fieldname", None)
-        value = scaling_factory.get_original_value(fieldname=fieldname)
-        if value is None:
-            # Either an empty value, or the field does not exist.
+        variants = {}
+        for output_format, variant in zip(output_formats, infos[1:]):
+            if variant is not None:
+                canonical = self.canonical_parameters(output_format=output_format)
+                mimetype = f"image/{canonical['output_format'].lower()}"
+                variants[mimetype] = variant["uid"]
+        if info.get("variants") != variants:
+            # Copy the info, because changes within the stored dict would
+            # not be saved.
+            info = info.copy()
+            info["variants"] = variants
+            if self.signing_key is None:
+                self._store({info["uid"]: info})
+        return info
+
+    def negotiate(self, info, accept):
+        """Return the variant of a scale that fits an Accept header best.
+
+        Variants are only used when their mimetype is explicitly accepted,
+        in the order in which they were registered.  Otherwise the info
+        itself is returned.
+        """
+        accepted = _parse_accept(accept)
+        base_quality = accepted.get(info.get("mimetype"), 0)
+        best = info
+        best_quality = 0
+        for mimetype, uid in info.get("variants", {}).items():
+            quality = accepted.get(mimetype, 0)
+            if quality <= best_quality or quality < base_quality:
+                continue
+            variant = self.get(uid)
+            if variant is None and self.parameters_from_uid(uid) is not None:
+                # Signed uids are not stored.  The variant has the same size.
+                variant = ScaleInfo(
+                    uid=uid,
+                    mimetype=mimetype,
+                    data=None,
+                    width=info.get("width"),
+                    height=info.get("height"),
+                )
+            if variant is not None:
+                best = self._resolve(variant) or best
+                best_quality = quality
+        return best
+
+    def _queue_jobs(self, status, jobs):
+        if not status:
             return
+        for job in jobs:
+            self.queue.put(job)
 
-        # There is no info, or it is outdated.  Recreate the scale info.
-        # We need width and height for various reasons.
-        # Start with a basis.
-        width = parameters.get("width")
-        height = parameters.get("height")
-        orig_width, orig_height = value.getImageSize()
-        mode = get_scale_mode(parameters.get("mode"), parameters.get("direction"))
-        width, height = calculate_scaled_dimensions(
-            orig_width, orig_height, width, height, mode
-        )
-        mimetype = value.contentType
-        key = self.hash(**parameters)
-        info = dict(
-            uid=uid,
-            key=key,
-            modified=int(time() * 1000),
-            mimetype=mimetype,
-            data=None,
-            width=width,
-            height=height,
-        )
-        if fieldname:
-            info["fieldname"] = fieldname
-        self.storage[uid] = info
-        logger.debug(f"Pre scale returns new {info}")
-        return info
+    def process_job(self, job):
+        """Generate the scale for a job from the background queue."""
+        info = self.get(job.uid)
+        if info is not None and has_data(info):
+            return info
+        return self._generate_once(job.uid, job.parameters)
 
     def generate_scale(self, uid=None, **parameters):
         logger.debug("Generating scale...")
@@ -272,7 +887,9 @@ class AnnotationStorage(MutableMapping):
         if scaling_factory is None:
             # There is nothing we can do.
             return
+        start = perf_counter()
         result = scaling_factory(**parameters)
+        get_sink().observe("generate", perf_counter() - start)
         if result is None:
             return
         # storage will be modified:
@@ -284,7 +901,10 @@ class AnnotationStorage(MutableMapping):
         if uid is None:
             uid = self.hash_key(**parameters)
         key = self.hash(**parameters)
-        info = dict(
+        if not isinstance(data, Persistent):
+            # Store the data separately, so it is only loaded when needed.
+            data = ScaleData(data)
+        info = ScaleInfo(
             uid=uid,
             data=data,
             width=width,
@@ -295,44 +915,99 @@ class AnnotationStorage(MutableMapping):
         )
         if fieldname:
             info["fieldname"] = fieldname
-        self.storage[uid] = info
+        version = self.original_version(fieldname)
+        if version is not None:
+            info["version"] = version
+        previous = self.get(uid)
+        if previous is not None and previous.get("variants"):
+            # Keep the variants registered by pre_scale_variants.
+            info["variants"] = previous["variants"]
+        self._store({uid: info})
         logger.debug(f"Generated scale: {info}")
         return info
 
+    @timed("scale")
     def scale(self, **parameters):
         logger.debug(f"scale called with {parameters}")
         uid = self.hash_key(**parameters)
         info = self.get(uid)
         if info is None:
-            # Might be on old-style uuid4 scale
-            key = self.hash(**parameters)
-            info = self.get_info_by_hash(key)
-        if (
-            info is not None
-            and info.get("data") is not None
-            and not self._modified_since(info["modified"])
-        ):
-            logger.debug(f"scale found existing info {info}")
-            return info
+            info = self._get_legacy(parameters)
+        if info is None:
+            # Might be on old-style uuid4 scale, or an outdated scale.
+            # That may have been stored with another spelling of the
+            # parameters, so also look for the canonical form.
+            info = self.get_info_by_hash(self.hash(**parameters))
+            if info is None:
+                info = self._get_info_by_canonical(parameters)
+        if info is not None:
+            info = self._resolve(info)
+        if info is not None and has_data(info):
+            if not self._outdated(info):
+                logger.debug(f"scale found existing info {info}")
+                get_sink().increment("scale", result="hit")
+                # Pages render scales without their data, so only use
+                # data that is already cached.
+                return self._with_cached_data(info, fill=False)
+            if self._may_serve_stale(info):
+                logger.debug(f"scale found outdated info {info}, revalidating")
+                get_sink().increment("scale", result="stale")
+                # No placeholder is needed, so the job can be queued now.
+                self.queue.put(ScaleJob(self.context_key, uid, parameters))
+                return info
+        get_sink().increment("scale", result="miss")
         return self.generate_scale(**parameters)
 
+    def _may_serve_stale(self, info):
+        if self.queue is None or self.max_staleness is None:
+            return False
+        return not self._modified_since(info["modified"], offset=self.max_staleness)
+
+    @timed("get_or_generate")
     def get_or_generate(self, name):
         logger.debug(f"get or generate {name}")
         info = self.get(name)
         if info is None:
+            parameters = self.parameters_from_uid(name)
+            if parameters is not None:
+                # Signed uid from a write-free pre_scale.
+                get_sink().increment("get_or_generate", result="generated")
+                return self._generate_once(name, parameters)
             logger.debug(f"get or generate {name} not found")
+            get_sink().increment("get_or_generate", result="not_found")
             return
-        if info is not None and info.get("data") is not None:
+        target = self._resolve(info)
+        if target is not None:
+            # Use the scale that an alias points to.
+            info = target
+            name = info["uid"]
+        if has_data(info):
             # We could check 'self._modified_since(info["modified"])'.
             # But in fact we do not care if this scale is outdated.
             # A cached page may point to this, and the browser requests it now.
             logger.debug(f"get or generate {name} found {info}")
-            return info
+            get_sink().increment("get_or_generate", result="hit")
+            return self._with_cached_data(info)
         # This scale has not been generated yet.
         # Get the parameters used when pre-registering this scale.
         parameters = self.unhash(info["key"])
-        return self.generate_scale(uid=name, **parameters)
+        get_sink().increment("get_or_generate", result="generated")
+        return self._generate_once(name, parameters)
+
+    def _generate_once(self, uid, parameters):
+        if self.single_flight is None:
+            return self.generate_scale(uid=uid, **parameters)
+
+        def generate():
+            # Another thread may have finished it meanwhile.
+            info = self.get(uid)
+            if info is not None and has_data(info):
+                return info
+            return self.generate_scale(uid=uid, **parameters)
 
+        return self.single_flight.do((self.context_key, uid), generate, _detached)
+
+    @timed("cleanup")
     def _cleanup(self, fieldname=None):
         storage = self.storage
         modified_time = self.modified_time
@@ -350,12 +1025,73 @@ class AnnotationStorage(MutableMapping):
                 # Leave scales for other fieldnames alone.
                 # self.modified may have nothing to do with that field.
                 continue
-            # clear cache from scales older than one day
-            elif self._modified_since(value["modified"], offset=KEEP_SCALE_MILLIS):
+            # clear cache from scales older than one day,
+            # unless they were made from the current version of the image
+            elif self._modified_since(
+                value["modified"], offset=KEEP_SCALE_MILLIS
+            ) and not self._current_version(value):
                 del self[key]
+                get_sink().increment("cleanup_deleted")
+
+    def _store(self, infos):
+        """Write scale infos to the storage in one mapping update."""
+        self.storage.update(infos)
+        self.invalidate_cache()
+        for uid in infos:
+            self._invalidate_data(uid)
+
+    def _invalidate_data(self, uid):
+        if self.data_cache is not None:
+            self.data_cache.invalidate((self.context_key, uid))
+
+    def _with_cached_data(self, info, fill=True):
+        """Return the info with its data from ``data_cache``.
+
+        This is a copy of the info, so the stored data is not loaded from
+        the database.  With ``fill``, data that is not cached yet is read
+        and cached.  Data stored by the factory as another persistent
+        object, like a blob, is left alone.
+        """
+        cache = self.data_cache
+        if cache is None or not isinstance(dict.get(info, "data"), ScaleData):
+            return info
+        key = (self.context_key, info["uid"])
+        data = cache.get(key)
+        if data is None:
+            if fill:
+                cache.set(key, info["data"])
+            return info
+        info = info.copy()
+        info["data"] = data
+        return info
+
+    def get_data(self, uid):
+        """Return the data of a generated scale, or None.
+
+        Blob-like values with a ``data`` attribute are read.
+        When ``data_cache`` is set, the data is cached there.
+        """
+        cache = self.data_cache
+        key = (self.context_key, uid)
+        if cache is not None:
+            data = cache.get(key)
+            if data is not None:
+                return data
+        info = self.get(uid)
+        if info is not None:
+            info = self._resolve(info)
+        if info is None:
+            return None
+        data = info.get("data")
+        if data is None:
+            return None
+        data = getattr(data, "data", data)
+        if cache is not None:
+            cache.set(key, data)
+        return data
 
     def __getitem__(self, uid):
-        return self.storage[uid]
+        return self._scales[uid]
 
     def __setitem__(self, id, scale):
         raise RuntimeError("New scales have to be created via scale()")
@@ -367,20 +1103,27 @@ class AnnotationStorage(MutableMapping):
             # This should not happen, but it apparently can happen in corner
             # cases.  See https://github.com/plone/plone.scale/issues/15
             logger.warning("Could not delete key %s from storage.", uid)
+        self.invalidate_cache()
+        self._invalidate_data(uid)
 
     def __iter__(self):
-        return iter(self.storage)
+        return iter(self._scales)
 
     def __len__(self):
         return len(self.keys())
 
     def keys(self):
-        return self.storage.keys()
+        return self._scales.keys()
 
     def has_key(self, uid):
-        return uid in self.storage
+        return uid in self._scales
 
     __contains__ = has_key
 
     def clear(self):
-        self.storage.clear()
+        scales = self._scales
+        if self.data_cache is not None:
+            for uid in scales:
+                self._invalidate_data(uid)
+        scales.clear()
+        self.invalidate_cache()
@@ -0,0 +1,51 @@
+from plone.scale.background import HIGH_PRIORITY
+from plone.scale.background import LOW_PRIORITY
+from plone.scale.background import ScaleJob
+from plone.scale.background import ScaleQueue
+from unittest import TestCase
+
+
+class ScaleQueueTests(TestCase):
+    def test_priorities(self):
+        done = []
+        queue = ScaleQueue(lambda job: done.append(job.uid))
+        queue.put(ScaleJob("ctx", "low", {}, LOW_PRIORITY))
+        queue.put(ScaleJob("ctx", "default-1", {}))
+        queue.put(ScaleJob("ctx", "high", {}, HIGH_PRIORITY))
+        queue.put(ScaleJob("ctx", "default-2", {}))
+        self.assertEqual(len(queue), 4)
+        queue.start()
+        queue.join()
+        queue.stop()
+        self.assertEqual(done, ["high", "default-1", "default-2", "low"])
+        self.assertEqual(len(queue), 0)
+
+    def test_duplicates_ignored(self):
+        done = []
+        queue = ScaleQueue(lambda job: done.append(job.uid))
+        self.assertTrue(queue.put(ScaleJob("ctx", "uid", {})))
+        self.assertFalse(queue.put(ScaleJob("ctx", "uid", {})))
+        self.assertTrue(queue.put(ScaleJob("other", "uid", {})))
+        queue.start()
+        queue.join()
+        # Once done, the same scale can be queued again.
+        self.assertTrue(queue.put(ScaleJob("ctx", "uid", {})))
+        queue.join()
+        queue.stop()
+        self.assertEqual(done, ["uid", "uid", "uid"])
+
+    def test_failing_runner(self):
+        done = []
+
+        def runner(job):
+            if job.uid == "broken":
+                raise ValueError(job.uid)
+            done.append(job.uid)
+
+        queue = ScaleQueue(runner, workers=2)
+        queue.put(ScaleJob("ctx", "broken", {}, HIGH_PRIORITY))
+        queue.put(ScaleJob("ctx", "fine", {}))
+        queue.start()
+        queue.join()
+        queue.stop()
+        self.assertEqual(done, ["fine"])
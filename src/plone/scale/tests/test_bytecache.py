@@ -0,0 +1,44 @@
+from plone.scale.bytecache import ScaleDataCache
+from unittest import TestCase
+
+
+class ScaleDataCacheTests(TestCase):
+    def test_get_and_set(self):
+        cache = ScaleDataCache(max_bytes=10)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", b"1234")
+        self.assertEqual(cache.get("a"), b"1234")
+        self.assertEqual(
+            cache.stats(), dict(hits=1, misses=1, evictions=0, items=1, size=4)
+        )
+        cache.set("a", b"12")
+        self.assertEqual(cache.size, 2)
+
+    def test_eviction_least_recently_used(self):
+        cache = ScaleDataCache(max_bytes=10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        cache.get("a")
+        cache.set("c", b"1234")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, 8)
+
+    def test_too_big(self):
+        cache = ScaleDataCache(max_bytes=10)
+        cache.set("a", b"12345678901")
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_clear(self):
+        cache = ScaleDataCache(max_bytes=10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        cache.invalidate("a")
+        cache.invalidate("unknown")
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.size, 4)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
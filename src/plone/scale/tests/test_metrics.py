@@ -0,0 +1,62 @@
+from plone.scale.metrics import get_sink
+from plone.scale.metrics import NullSink
+from plone.scale.metrics import PrometheusSink
+from plone.scale.metrics import set_sink
+from unittest import TestCase
+
+import os
+import tempfile
+
+
+class PrometheusSinkTests(TestCase):
+    def test_render(self):
+        sink = PrometheusSink(buckets=(0.1, 1))
+        sink.increment("scale", result="hit")
+        sink.increment("scale", result="hit")
+        sink.increment("scale", result="miss")
+        sink.increment("cleanup_deleted", 3)
+        sink.observe("generate", 0.05)
+        sink.observe("generate", 0.5)
+        sink.observe("generate", 2)
+        self.assertEqual(sink.counter("scale", result="hit"), 2)
+        self.assertEqual(sink.histogram_count("generate"), 3)
+        self.assertEqual(
+            sink.render(),
+            """\
+# TYPE plone_scale_cleanup_deleted_total counter
+plone_scale_cleanup_deleted_total 3
+# TYPE plone_scale_scale_total counter
+plone_scale_scale_total{result="hit"} 2
+plone_scale_scale_total{result="miss"} 1
+# TYPE plone_scale_generate_seconds histogram
+plone_scale_generate_seconds_bucket{le="0.1"} 1
+plone_scale_generate_seconds_bucket{le="1"} 2
+plone_scale_generate_seconds_bucket{le="+Inf"} 3
+plone_scale_generate_seconds_sum 2.55
+plone_scale_generate_seconds_count 3
+""",
+        )
+
+    def test_label_escaping(self):
+        sink = PrometheusSink()
+        sink.increment("scale", result='a "b"\\c')
+        self.assertIn('{result="a \\"b\\"\\\\c"}', sink.render())
+
+    def test_write(self):
+        sink = PrometheusSink()
+        sink.increment("scale", result="hit")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "plone_scale.prom")
+            sink.write(path)
+            with open(path) as prom_file:
+                self.assertEqual(prom_file.read(), sink.render())
+            self.assertEqual(os.listdir(directory), ["plone_scale.prom"])
+
+    def test_set_sink(self):
+        sink = PrometheusSink()
+        set_sink(sink)
+        try:
+            self.assertIs(get_sink(), sink)
+        finally:
+            set_sink(None)
+        self.assertIsInstance(get_sink(), NullSink)
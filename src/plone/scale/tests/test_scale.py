@@ -8,7 +8,9 @@ from unittest import TestCase
 
 import functools
 import PIL.Image
+import PIL.ImageChops
 import PIL.ImageDraw
+import PIL.ImageStat
 import warnings
 
 PNG = (TEST_DATA_LOCATION / "logo.png").read_bytes()
@@ -481,6 +483,55 @@ class ScalingTests(TestCase):
         # Scale with height `0`
         self.assertEqual(calc(100, 100, 50, 0), (50, 50))
 
+    def test_plan_srcset(self):
+        from plone.scale.scale import plan_srcset
+
+        # Widths bigger than the original give the original size once.
+        self.assertEqual(
+            plan_srcset(900, 600, [400, 800, 1200, 1600]),
+            [
+                (dict(width=400), (400, 266)),
+                (dict(width=800), (800, 533)),
+                (dict(width=1200), (900, 600)),
+            ],
+        )
+        # Almost the same size: the bigger one is kept.
+        self.assertEqual(
+            [size for parameters, size in plan_srcset(3000, 2000, [800, 820, 1600])],
+            [(820, 546), (1600, 1066)],
+        )
+        self.assertEqual(len(plan_srcset(3000, 2000, [800, 820, 1600], threshold=0)), 3)
+        self.assertEqual(
+            len(plan_srcset(3000, 2000, [800, 1000, 1600], threshold=0.6)), 2
+        )
+        # Height and mode for plain widths, or dicts with parameters.
+        self.assertEqual(
+            plan_srcset(
+                900,
+                600,
+                [100, dict(width=300, height=200, mode="contain")],
+                height=100,
+                mode="cover",
+            ),
+            [
+                (dict(width=100, height=100, mode="cover"), (100, 67)),
+                (dict(width=300, height=200, mode="contain"), (300, 200)),
+            ],
+        )
+        # Only upscaling: the smallest is kept.
+        self.assertEqual(
+            plan_srcset(100, 100, [dict(width=300, height=200, mode="contain")]),
+            [(dict(width=300, height=200, mode="contain"), (300, 200))],
+        )
+        self.assertEqual(plan_srcset(100, 100, []), [])
+        # The deprecated direction is used like in scaleImage.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            self.assertEqual(
+                plan_srcset(900, 600, [dict(width=400, direction="down")]),
+                [(dict(width=400, direction="down"), (400, 400))],
+            )
+
     def testAnimatedGifContainsAllFrames(self):
         image = scaleImage(ANIGIF, 84, 103, "contain")[0]
         with PIL.Image.open(StringIO(image)) as img:
@@ -538,6 +589,564 @@ class ScalingTests(TestCase):
         self.assertGreaterEqual(dimensions.target_width, 1)
         self.assertGreaterEqual(dimensions.target_height, 1)
 
+    def testInstrument(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        instrument = ScaleInstrument()
+        imagedata, format_, size = scaleImage(
+            GREYSCALE_IMG, 100, None, "contain", instrument=instrument
+        )
+        names = [stage["name"] for stage in instrument.stages]
+        self.assertEqual(
+            names, ["open", "decode", "convert", "resize", "analyse", "save"]
+        )
+        for stage in instrument.stages:
+            self.assertGreaterEqual(stage["wall"], 0)
+            self.assertGreaterEqual(stage["cpu"], 0)
+        resize = instrument.stages[3]
+        self.assertEqual(resize["target_pixels"], size[0] * size[1])
+        self.assertEqual(instrument.details["input_bytes"], len(GREYSCALE_IMG))
+        self.assertEqual(instrument.details["input_format"], "PNG")
+        self.assertEqual(instrument.details["output_bytes"], len(imagedata))
+        self.assertEqual(instrument.details["output_format"], format_)
+        self.assertEqual(instrument.details["size"], size)
+
+    def testInstrumentScaleMode(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        instrument = ScaleInstrument()
+        result = StringIO()
+        scaleImage(PROFILE, 42, 42, "scale", result=result, instrument=instrument)
+        names = [stage["name"] for stage in instrument.stages]
+        self.assertEqual(names, ["open", "decode", "resize", "analyse", "save"])
+        self.assertEqual(instrument.details["input_bytes"], len(PROFILE))
+        self.assertEqual(instrument.details["output_bytes"], len(result.getvalue()))
+
+    def testInstrumentDecodeStage(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        # Same aspect ratio: JPEG draft decoding is its own stage.
+        instrument = ScaleInstrument()
+        scaleImage(PROFILE, 50, 50, "contain", instrument=instrument)
+        names = [stage["name"] for stage in instrument.stages]
+        self.assertEqual(names, ["open", "decode", "resize", "analyse", "save"])
+
+    def testInstrumentFrames(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        instrument = ScaleInstrument()
+        scaleImage(ANIGIF, 50, 50, instrument=instrument)
+        self.assertEqual(instrument.details["frames"], 6)
+        instrument = ScaleInstrument()
+        scaleImage(PNG, 50, 50, instrument=instrument)
+        self.assertEqual(instrument.details["frames"], 1)
+
+    def testInstrumentFailedStage(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        instrument = ScaleInstrument()
+        with self.assertRaises(ValueError):
+            with instrument.stage("resize", target_pixels=42):
+                raise ValueError("broken")
+        self.assertEqual(len(instrument.stages), 1)
+        self.assertEqual(instrument.stages[0]["name"], "resize")
+        self.assertEqual(instrument.stages[0]["target_pixels"], 42)
+        self.assertGreaterEqual(instrument.stages[0]["wall"], 0)
+
+    def _band_reduce_source(self, format_):
+        src = PIL.Image.new("RGB", (1200, 900), (255, 0, 0))
+        draw = PIL.ImageDraw.Draw(src)
+        draw.rectangle((0, 450, 1200, 900), fill=(0, 0, 255))
+        result = StringIO()
+        src.save(result, format_)
+        return result.getvalue()
+
+    def testBandReduce(self):
+        import plone.scale.scale
+
+        for format_ in ("TIFF", "BMP", "PPM"):
+            data = self._band_reduce_source(format_)
+            with PIL.Image.open(StringIO(data)) as img:
+                reduced = plone.scale.scale._band_reduce(img, 4)
+            self.assertEqual(reduced.size, (300, 225), format_)
+            # Top is red and bottom is blue, also for bottom up formats.
+            self.assertEqual(reduced.getpixel((10, 10)), (255, 0, 0), format_)
+            self.assertEqual(reduced.getpixel((10, 200)), (0, 0, 255), format_)
+
+    def testBandReduceUnsupported(self):
+        import plone.scale.scale
+
+        with PIL.Image.open(StringIO(PNG)) as img:
+            self.assertIsNone(plone.scale.scale._band_reduce(img, 4))
+        with PIL.Image.open(StringIO(self._band_reduce_source("TIFF"))) as img:
+            self.assertIsNone(plone.scale.scale._band_reduce(img, 1))
+
+    def testScaleLargeImageInBands(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        import plone.scale.scale
+
+        data = self._band_reduce_source("TIFF")
+        expected = scaleImage(data, 200, 150, "scale")
+        self.patch(plone.scale.scale, "BAND_REDUCE_PIXELS", 1000)
+        # Several bands.
+        self.patch(plone.scale.scale, "BAND_BYTES", 100 * 1200 * 3)
+        instrument = ScaleInstrument()
+        imagedata, format_, size = scaleImage(
+            data, 200, 150, "scale", instrument=instrument
+        )
+        self.assertIn("reduce", [stage["name"] for stage in instrument.stages])
+        self.assertEqual(size, expected[2])
+        self.assertEqual(format_, expected[1])
+        image = PIL.Image.open(StringIO(imagedata))
+        red = image.getpixel((100, 10))
+        blue = image.getpixel((100, 140))
+        self.assertGreater(red[0], 240)
+        self.assertGreater(blue[2], 240)
+        # Cropping modes work too.
+        self.assertEqual(scaleImage(data, 100, 150, "contain")[2], (100, 150))
+
+    def testScaleLargeImageInBandsSize(self):
+        import plone.scale.scale
+
+        self.patch(plone.scale.scale, "BAND_REDUCE_PIXELS", 1000)
+        # The reduced image has a partial last row and column.
+        src = PIL.Image.new("RGB", (1203, 907), (255, 0, 0))
+        for format_ in ("TIFF", "BMP", "PPM"):
+            result = StringIO()
+            src.save(result, format_)
+            for width, height, mode in (
+                (200, None, "scale"),
+                (200, 150, "cover"),
+                (333, 77, "contain"),
+            ):
+                expected = calculate_scaled_dimensions(1203, 907, width, height, mode)
+                with self.subTest(format_=format_, mode=mode):
+                    size = scaleImage(result.getvalue(), width, height, mode)[2]
+                    self.assertEqual(size, expected)
+
+    def testReducingGap(self):
+        import plone.scale.scale
+
+        src = PIL.Image.radial_gradient("L").resize((1600, 1200)).convert("RGB")
+        PIL.ImageDraw.Draw(src).rectangle((400, 300, 800, 600), fill=(200, 30, 30))
+        for mode in ("scale", "contain", "cover"):
+            reduced = scalePILImage(src.copy(), 100, 60, mode)
+            self.patch(plone.scale.scale, "REDUCING_GAP", None)
+            full = scalePILImage(src.copy(), 100, 60, mode)
+            self.patch(plone.scale.scale, "REDUCING_GAP", 3.0)
+            self.assertEqual(reduced.size, full.size)
+            difference = PIL.ImageChops.difference(reduced, full)
+            self.assertLess(max(PIL.ImageStat.Stat(difference).mean), 1.0, mode)
+
+    def testConvertCMYKAfterDraftAndCrop(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        src = PIL.Image.radial_gradient("L").resize((1600, 1200)).convert("CMYK")
+        data = StringIO()
+        src.save(data, "JPEG")
+        for mode, width, height in (
+            ("scale", 100, 75),
+            ("contain", 100, 25),
+            ("contain", 100, 75),
+            ("cover", 100, 75),
+        ):
+            instrument = ScaleInstrument()
+            imagedata, format_, size = scaleImage(
+                data.getvalue(), width, height, mode, instrument=instrument
+            )
+            self.assertEqual(size, (width, height), mode)
+            self.assertEqual(PIL.Image.open(StringIO(imagedata)).mode, "L", mode)
+            converted = [
+                stage["pixels"]
+                for stage in instrument.stages
+                if stage["name"] == "convert"
+            ]
+            # Decoded in draft mode, and cropped, before converting.
+            self.assertEqual(len(converted), 1, mode)
+            self.assertLessEqual(converted[0], 200 * 150, mode)
+
+    def testConvertAfterNearestResize(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        gradient = PIL.Image.linear_gradient("L").resize((400, 300))
+        src = PIL.Image.merge("RGB", (gradient, gradient.rotate(180), gradient))
+        src = src.quantize(16)
+        src.info["transparency"] = 3
+        for mode in ("scale", "contain", "cover"):
+            instrument = ScaleInstrument()
+            scaled = scalePILImage(
+                src.copy(), 40, 20, mode, resample=0, instrument=instrument
+            )
+            expected = scalePILImage(src.convert("RGBA"), 40, 20, mode, resample=0)
+            self.assertEqual(scaled.mode, "RGBA")
+            self.assertEqual(scaled.tobytes(), expected.tobytes(), mode)
+            convert = [s for s in instrument.stages if s["name"] == "convert"]
+            self.assertEqual(convert[0]["pixels"], scaled.width * scaled.height)
+
+    def testSourceBox(self):
+        from plone.scale.scale import _calculate_all_dimensions
+
+        dimensions = _calculate_all_dimensions(300, 100, 100, 100, "contain")
+        self.assertEqual(dimensions.source_box, (100, 0, 200, 100))
+        dimensions = _calculate_all_dimensions(100, 300, 50, 50, "contain")
+        self.assertEqual(dimensions.source_box, (0, 100, 100, 200))
+        # No rounding: the box has the aspect ratio of the final size.
+        dimensions = _calculate_all_dimensions(1000, 999, 100, 33, "contain")
+        left, top, right, bottom = dimensions.source_box
+        self.assertEqual((right - left) * 33, (bottom - top) * 100)
+        self.assertEqual((left, right), (0, 1000))
+        self.assertEqual(top, 999 - bottom)
+
+    def testCropAndResizeCentered(self):
+        src = PIL.Image.new("RGB", (999, 301), (0, 0, 255))
+        draw = PIL.ImageDraw.Draw(src)
+        draw.rectangle((0, 0, 399, 300), fill=(255, 0, 0))
+        draw.rectangle((599, 0, 998, 300), fill=(255, 0, 0))
+        for mode, width, height in (
+            ("contain", 77, 77),
+            ("contain", 40, 60),
+            ("cover", 333, 100),
+        ):
+            scaled = scalePILImage(src.copy(), width, height, mode)
+            self.assertEqual(
+                scaled.size, calculate_scaled_dimensions(999, 301, width, height, mode)
+            )
+            mirrored = scaled.transpose(PIL.Image.Transpose.FLIP_LEFT_RIGHT)
+            difference = PIL.ImageChops.difference(scaled, mirrored)
+            self.assertLess(max(PIL.ImageStat.Stat(difference).mean), 1.0, mode)
+
+    def testSourceBoxInsideImage(self):
+        from plone.scale.scale import _calculate_all_dimensions
+
+        # Aspect ratios that do not divide, where float rounding could put
+        # the box outside the image.
+        for original, target, mode in (
+            ((1500, 900), (33, 77), "contain"),
+            ((333, 777), (1200, 800), "contain"),
+            ((1203, 907), (250, 250), "cover"),
+            ((3999, 2001), (600, 400), "contain"),
+        ):
+            dimensions = _calculate_all_dimensions(*original, *target, mode)
+            left, top, right, bottom = dimensions.source_box
+            self.assertGreaterEqual(min(left, top), 0, (original, target))
+            self.assertLessEqual(right, original[0])
+            self.assertLessEqual(bottom, original[1])
+            scaled = scalePILImage(PIL.Image.new("RGB", original), *target, mode)
+            self.assertEqual(
+                scaled.size, calculate_scaled_dimensions(*original, *target, mode)
+            )
+        data = StringIO()
+        PIL.Image.new("RGB", (1500, 900)).save(data, "JPEG")
+        self.assertEqual(scaleImage(data.getvalue(), 33, 77, "contain")[2], (33, 77))
+
+    def testZeroFinalDimension(self):
+        # Scaling to a zero width raises the same error as before.
+        self.assertEqual(calculate_scaled_dimensions(17, 2000, 5, 5, "cover"), (0, 5))
+        with self.assertRaises(ValueError):
+            scalePILImage(PIL.Image.new("RGB", (17, 2000)), 5, 5, "cover")
+
+    def testPassthrough(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        for data, format_, size in (
+            (PNG, "PNG", (84, 103)),
+            (PROFILE, "JPEG", (200, 200)),
+        ):
+            for width, height, mode in (
+                (200, 200, "scale"),
+                (size[0], None, "scale"),
+                (size[0], size[1], "contain"),
+                (size[0], 0, "cover"),
+            ):
+                instrument = ScaleInstrument()
+                self.assertEqual(
+                    scaleImage(
+                        data,
+                        width,
+                        height,
+                        mode,
+                        passthrough=True,
+                        instrument=instrument,
+                    ),
+                    (data, format_, size),
+                )
+                self.assertTrue(instrument.details["passthrough"])
+                self.assertEqual([s["name"] for s in instrument.stages], ["open"])
+        # Only when asked.
+        self.assertNotEqual(scaleImage(PNG, 200, 200)[0], PNG)
+        result = StringIO()
+        self.assertEqual(
+            scaleImage(PNG, 200, 200, result=result, passthrough=True),
+            (result, "PNG", (84, 103)),
+        )
+        self.assertEqual(result.read(), PNG)
+        # The original can be an open file.
+        self.assertEqual(scaleImage(StringIO(PNG), 200, 200, passthrough=True)[0], PNG)
+
+    def testNoPassthrough(self):
+        # Different size
+        self.assertNotEqual(scaleImage(PNG, 50, 50, passthrough=True)[0], PNG)
+        self.assertNotEqual(
+            scaleImage(PNG, 84, 84, "contain", passthrough=True)[0], PNG
+        )
+        # Converted to another format or mode
+        self.assertEqual(scaleImage(GIF, 200, 200, passthrough=True)[1], "PNG")
+        self.assertEqual(scaleImage(TIFF, 200, 200, passthrough=True)[1], "JPEG")
+        self.assertNotEqual(scaleImage(ANIGIF, 2000, 2000, passthrough=True)[0], ANIGIF)
+        # CMYK and EXIF
+        self.assertNotEqual(scaleImage(CMYK, 400, 400, passthrough=True)[0], CMYK)
+        # No size
+        self.assertRaises(ValueError, scaleImage, PNG, None, None, passthrough=True)
+        # Bigger than max_bytes
+        data, format_, size = scaleImage(
+            PROFILE, 800, 800, passthrough=True, max_bytes=len(PROFILE) // 2
+        )
+        self.assertEqual(size, (200, 200))
+        self.assertLessEqual(len(data), len(PROFILE) // 2)
+        self.assertEqual(
+            scaleImage(PROFILE, 800, 800, passthrough=True, max_bytes=len(PROFILE))[0],
+            PROFILE,
+        )
+
+    def testOutputFormat(self):
+        from plone.scale.scale import supports_output_format
+
+        for data in (PNG, PROFILE, GIF, TIFF):
+            for output_format, expected in (
+                ("webp", "WEBP"),
+                ("JPG", "JPEG"),
+                ("png", "PNG"),
+                ("GIF", "GIF"),
+            ):
+                imagedata, format_, size = scaleImage(
+                    data, 42, 51, output_format=output_format
+                )
+                self.assertEqual(format_, expected)
+                self.assertEqual(PIL.Image.open(StringIO(imagedata)).format, expected)
+        if supports_output_format("AVIF"):
+            imagedata, format_, size = scaleImage(PROFILE, 42, 51, output_format="avif")
+            self.assertEqual(PIL.Image.open(StringIO(imagedata)).format, "AVIF")
+        # Transparency is not lost.
+        self.assertEqual(
+            scaleImage(GREYSCALE_IMG, 42, 51, output_format="JPEG")[1], "PNG"
+        )
+        # Animations are not kept in another format.
+        imagedata, format_, size = scaleImage(ANIGIF, 42, 51, output_format="PNG")
+        self.assertFalse(getattr(PIL.Image.open(StringIO(imagedata)), "is_animated", 0))
+        # No passthrough to another format.
+        self.assertEqual(
+            scaleImage(PNG, 200, 200, passthrough=True, output_format="WEBP")[1], "WEBP"
+        )
+
+    def testUnsupportedOutputFormat(self):
+        from plone.scale.scale import supports_output_format
+
+        self.assertTrue(supports_output_format("jpeg"))
+        self.assertFalse(supports_output_format("BMP"))
+        self.assertFalse(supports_output_format("foo"))
+        self.assertRaises(ValueError, scaleImage, PNG, 42, 51, output_format="BMP")
+
+    def testMaxBytes(self):
+        from plone.scale.instrument import ScaleInstrument
+        from plone.scale.scale import MIN_QUALITY
+
+        src = PIL.Image.effect_noise((300, 300), 40).convert("RGB")
+        data = StringIO()
+        src.save(data, "PNG")
+        data = data.getvalue()
+        for output_format in ("JPEG", "WEBP"):
+            unlimited = scaleImage(data, 200, 200, output_format=output_format)[0]
+            # Enough room: the same as without a maximum.
+            self.assertEqual(
+                scaleImage(
+                    data,
+                    200,
+                    200,
+                    output_format=output_format,
+                    max_bytes=len(unlimited),
+                )[0],
+                unlimited,
+            )
+            instrument = ScaleInstrument()
+            max_bytes = len(unlimited) // 2
+            imagedata, format_, size = scaleImage(
+                data,
+                200,
+                200,
+                output_format=output_format,
+                max_bytes=max_bytes,
+                instrument=instrument,
+            )
+            self.assertLessEqual(len(imagedata), max_bytes)
+            self.assertEqual(PIL.Image.open(StringIO(imagedata)).size, (200, 200))
+            quality = instrument.details["quality"]
+            self.assertLess(quality, 88)
+            self.assertLessEqual(instrument.details["encode_attempts"], 8)
+            # The next quality would have been too big.
+            higher = scaleImage(
+                data, 200, 200, output_format=output_format, quality=quality + 1
+            )[0]
+            self.assertGreater(len(higher), max_bytes)
+            # Too small: the lowest quality.
+            instrument = ScaleInstrument()
+            scaleImage(
+                data,
+                200,
+                200,
+                output_format=output_format,
+                max_bytes=10,
+                instrument=instrument,
+            )
+            self.assertEqual(instrument.details["quality"], MIN_QUALITY)
+        # Lossless formats are saved as usual.
+        self.assertEqual(scaleImage(PNG, 42, 51, max_bytes=10), scaleImage(PNG, 42, 51))
+
+    def _durations(self, data):
+        image = PIL.Image.open(StringIO(data))
+        durations = []
+        for index in range(image.n_frames):
+            image.seek(index)
+            image.load()
+            durations.append(image.info.get("duration"))
+        return durations
+
+    def testAnimatedGifToWebp(self):
+        gif, gif_format, gif_size = scaleImage(ANIGIF, 100, 100)
+        webp, format_, size = scaleImage(ANIGIF, 100, 100, output_format="WEBP")
+        self.assertEqual(format_, "WEBP")
+        self.assertEqual(size, gif_size)
+        image = PIL.Image.open(StringIO(webp))
+        self.assertEqual(image.format, "WEBP")
+        self.assertEqual(image.n_frames, PIL.Image.open(StringIO(ANIGIF)).n_frames)
+        self.assertEqual(image.info["loop"], 0)
+        self.assertEqual(self._durations(webp), self._durations(ANIGIF))
+        self.assertLess(len(webp), len(gif))
+
+    def testAnimatedGifToWebpLoop(self):
+        frames = [
+            PIL.Image.new("RGB", (40, 40), color) for color in ("red", "green", "blue")
+        ]
+        for loop in (None, 3):
+            data = StringIO()
+            kwargs = dict(
+                save_all=True, append_images=frames[1:], duration=[50, 60, 70]
+            )
+            if loop is not None:
+                kwargs["loop"] = loop
+            frames[0].save(data, "GIF", **kwargs)
+            webp = scaleImage(data.getvalue(), 20, 20, output_format="WEBP")[0]
+            # A GIF without a loop count is played once.
+            self.assertEqual(PIL.Image.open(StringIO(webp)).info["loop"], loop or 1)
+            self.assertEqual(self._durations(webp), [50, 60, 70])
+            gif = scaleImage(data.getvalue(), 20, 20)[0]
+            self.assertEqual(self._durations(gif), [50, 60, 70])
+
+    def testToSRGB(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        original = PIL.Image.open(StringIO(PROFILE)).resize((42, 42)).convert("RGB")
+        results = {}
+        for to_srgb in (None, "before", "after"):
+            instrument = ScaleInstrument()
+            imagedata, format_, size = scaleImage(
+                PROFILE, 42, 42, to_srgb=to_srgb, instrument=instrument
+            )
+            image = PIL.Image.open(StringIO(imagedata))
+            self.assertEqual(size, (42, 42))
+            self.assertEqual(image.mode, "RGB")
+            stages = [stage["name"] for stage in instrument.stages]
+            if to_srgb is None:
+                self.assertEqual(
+                    image.info.get("icc_profile"), original.info.get("icc_profile")
+                )
+                self.assertNotIn("color", stages)
+            else:
+                self.assertIsNone(image.info.get("icc_profile"))
+                self.assertIn("color", stages)
+                if to_srgb == "before":
+                    self.assertLess(stages.index("color"), stages.index("resize"))
+                else:
+                    self.assertGreater(stages.index("color"), stages.index("resize"))
+            results[to_srgb] = image.convert("RGB")
+        # ProPhoto RGB looks different in sRGB.  Converting before or after
+        # scaling gives almost the same.
+        difference = PIL.ImageChops.difference(results[None], results["after"])
+        converted = max(PIL.ImageStat.Stat(difference).mean)
+        difference = PIL.ImageChops.difference(results["before"], results["after"])
+        self.assertLess(max(PIL.ImageStat.Stat(difference).mean), converted)
+
+    def testToSRGBCMYK(self):
+        from plone.scale.instrument import ScaleInstrument
+
+        instrument = ScaleInstrument()
+        imagedata, format_, size = scaleImage(
+            CMYK, 42, 42, to_srgb="after", instrument=instrument
+        )
+        image = PIL.Image.open(StringIO(imagedata))
+        self.assertEqual(size, (42, 42))
+        self.assertEqual(image.mode, "RGB")
+        # Only the pixels decoded in draft mode are converted.
+        color = [stage for stage in instrument.stages if stage["name"] == "color"]
+        self.assertLess(color[0]["pixels"], 200 * 200)
+        for mode in ("contain", "cover"):
+            size = scaleImage(CMYK, 33, 17, mode, to_srgb="before")[2]
+            self.assertEqual(size, calculate_scaled_dimensions(200, 200, 33, 17, mode))
+        self.assertIsNone(image.info.get("icc_profile"))
+        # The embedded CMYK profile alone is more than 500 KB.
+        self.assertLess(len(imagedata), 10000)
+        self.assertGreater(len(scaleImage(CMYK, 42, 42)[0]), 500000)
+
+    def testToSRGBProfileLeftOut(self):
+        from PIL import ImageCms
+
+        srgb = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+        data = StringIO()
+        PIL.Image.open(StringIO(PROFILE)).save(data, "JPEG", icc_profile=srgb)
+        data = data.getvalue()
+        imagedata = scaleImage(data, 42, 42, to_srgb="before")[0]
+        self.assertIsNone(PIL.Image.open(StringIO(imagedata)).info.get("icc_profile"))
+        # Without conversion.
+        self.assertEqual(
+            PIL.Image.open(StringIO(imagedata)).tobytes(),
+            PIL.Image.open(StringIO(scaleImage(data, 42, 42)[0])).tobytes(),
+        )
+        # The original is not passed through with its profile.
+        imagedata = scaleImage(PROFILE, 200, 200, passthrough=True, to_srgb="after")[0]
+        self.assertNotEqual(imagedata, PROFILE)
+        self.assertIsNone(PIL.Image.open(StringIO(imagedata)).info.get("icc_profile"))
+        # Images without profile and greyscale images are left alone.
+        self.assertEqual(
+            scaleImage(PNG, 42, 51, to_srgb="after"), scaleImage(PNG, 42, 51)
+        )
+        self.assertRaises(ValueError, scaleImage, PNG, 42, 51, to_srgb="yes")
+
+    def testToSRGBProfileNamedSRGB(self):
+        from PIL import ImageCms
+
+        original = PIL.Image.open(StringIO(PROFILE))
+        # A ProPhoto profile that claims to be sRGB in its description.
+        profile = original.info["icc_profile"].replace(b"ProPhoto RGB", b"Linear sRGB ")
+        description = ImageCms.getProfileDescription(
+            ImageCms.ImageCmsProfile(StringIO(profile))
+        )
+        self.assertIn("sRGB", description)
+        data = StringIO()
+        original.save(data, "JPEG", icc_profile=profile)
+        data = data.getvalue()
+        # The colors are converted, not only the profile dropped.
+        imagedata = scaleImage(data, 42, 42, to_srgb="before")[0]
+        self.assertIsNone(PIL.Image.open(StringIO(imagedata)).info.get("icc_profile"))
+        self.assertNotEqual(
+            PIL.Image.open(StringIO(imagedata)).tobytes(),
+            PIL.Image.open(StringIO(scaleImage(data, 42, 42)[0])).tobytes(),
+        )
+
+    def patch(self, obj, name, value):
+        old = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, old)
+
     def testScaleSVGImage(self):
         # Basic scaling test
         scaled_svg = scale_svg_image(StringIO(SVG), 200, 100)
@@ -0,0 +1,109 @@
+from plone.scale.singleflight import SingleFlight
+from unittest import TestCase
+
+import threading
+
+
+class SingleFlightTests(TestCase):
+    def _run_concurrently(self, flight, key, func, count=5, share=None):
+        results = []
+        errors = []
+
+        def target():
+            try:
+                results.append(flight.do(key, func, share))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "result"
+
+        threads, results, errors = self._run_concurrently(flight, "key", func)
+        started.wait()
+        # Give the followers some time to queue up behind the leader.
+        for thread in threads:
+            thread.join(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(errors, [])
+
+    def test_sequential_calls_run_again(self):
+        flight = SingleFlight()
+        calls = []
+        flight.do("key", lambda: calls.append(1))
+        flight.do("key", lambda: calls.append(1))
+        self.assertEqual(len(calls), 2)
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait()
+            raise ValueError("broken")
+
+        threads, results, errors = self._run_concurrently(flight, "key", func, 3)
+        for thread in threads:
+            thread.join(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(error, ValueError) for error in errors))
+        # The key is released after the error.
+        self.assertEqual(flight.do("key", lambda: 42), 42)
+
+    def test_share(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        produced = []
+        shared = []
+
+        def func():
+            produced.append(["result"])
+            started.set()
+            release.wait()
+            return produced[0]
+
+        def share(result):
+            shared.append(list(result))
+            return shared[-1]
+
+        threads, results, errors = self._run_concurrently(flight, "key", func, 3, share)
+        started.wait()
+        for thread in threads:
+            thread.join(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        # The first caller gets the result, the others one shared copy.
+        self.assertEqual(len(produced), 1)
+        self.assertEqual(len(shared), 1)
+        self.assertEqual(results, [["result"]] * 3)
+        self.assertEqual(len([r for r in results if r is produced[0]]), 1)
+        self.assertEqual(len([r for r in results if r is shared[0]]), 2)
+
+    def test_share_only_with_followers(self):
+        flight = SingleFlight()
+        shared = []
+        self.assertEqual(flight.do("key", lambda: 42, shared.append), 42)
+        self.assertEqual(shared, [])
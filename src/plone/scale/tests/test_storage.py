@@ -1,11 +1,16 @@
 from operator import delitem
 from operator import itemgetter
 from operator import setitem
+from persistent import Persistent
 from plone.testing import zca
 from unittest import TestCase
+from zope.annotation.interfaces import IAnnotations
 from zope.component import provideAdapter
 from zope.interface import implementer
 
+import itertools
+import pickle
+import threading
 import zope.annotation.attribute
 import zope.annotation.interfaces
 
@@ -25,10 +30,14 @@ class _DummyContext:
     pass
 
 
+class _PersistentContext(Persistent, _DummyContext):
+    pass
+
+
 class AnnotationStorageTests(TestCase):
     layer = zca.UNIT_TESTING
 
-    def _provide_dummy_scale_adapter(self, result=_marker):
+    def _provide_dummy_scale_adapter(self, result=_marker, version=None):
         from plone.scale.interfaces import IImageScaleFactory
         from zope.component import adapter
 
@@ -50,6 +59,11 @@ class AnnotationStorageTests(TestCase):
             def get_original_value(self, fieldname=None):
                 return result
 
+            def get_original_version(self, fieldname=None):
+                if callable(version):
+                    return version()
+                return version
+
         provideAdapter(DummyISF)
 
     @property
@@ -161,6 +175,157 @@ class AnnotationStorageTests(TestCase):
         self.assertIn("fieldname", scale)
         self.assertEqual(scale["fieldname"], "image")
 
+    def test_pre_scale_many(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        writes = []
+        store = storage._store
+        storage._store = lambda infos: writes.append(infos) or store(infos)
+        infos = storage.pre_scale_many(
+            [
+                dict(width=50, height=80),
+                dict(width=30, height=30, mode="contain"),
+                dict(width=50, height=80),
+            ]
+        )
+        self.assertEqual(len(infos), 3)
+        self.assertEqual((infos[0]["width"], infos[0]["height"]), (50, 33))
+        self.assertEqual((infos[1]["width"], infos[1]["height"]), (30, 30))
+        self.assertIs(infos[2], infos[0])
+        self.assertEqual(len(storage), 2)
+        self.assertEqual(len(writes), 1)
+        # The same uids as with separate pre_scale calls.
+        self.assertEqual(storage.pre_scale(width=50, height=80), infos[0])
+        # Nothing new: no write.
+        infos2 = storage.pre_scale_many([dict(width=30, height=30, mode="contain")])
+        self.assertEqual(infos2, [infos[1]])
+        self.assertEqual(len(writes), 1)
+
+    def test_pre_scale_many_alias(self):
+        # The original is 60x40, so all these widths give the same scale.
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        srcset = [dict(width=width) for width in (100, 200, 400)]
+        infos = storage.pre_scale_many(srcset)
+        self.assertIs(infos[1], infos[0])
+        self.assertIs(infos[2], infos[0])
+        self.assertEqual((infos[0]["width"], infos[0]["height"]), (60, 40))
+        self.assertEqual(len(storage), 3)
+        target = infos[0]["uid"]
+        aliases = [storage.hash_key(**parameters) for parameters in srcset[1:]]
+        for uid in aliases:
+            self.assertEqual(storage[uid]["alias"], target)
+        self.assertIs(storage.pre_scale(**srcset[2]), infos[0])
+        # Later requests are aliased too.
+        self.assertIs(storage.pre_scale(width=800), infos[0])
+        self.assertEqual(len(storage), 4)
+        # Generating an alias generates the scale it points to.
+        scale = storage.get_or_generate(aliases[0])
+        self.assertEqual(scale["uid"], target)
+        self.assertEqual(scale["data"], "some data")
+        self.assertIs(storage.get_or_generate(aliases[1]), scale)
+        self.assertIs(storage.get_or_generate(target), scale)
+        self.assertEqual(storage.get_data(aliases[1]), "some data")
+        self.assertIs(storage.scale(width=400), scale)
+
+    def test_pre_scale_many_no_alias(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        infos = storage.pre_scale_many(
+            [
+                dict(width=100),
+                dict(width=100, height=100, mode="contain"),
+                dict(width=100, quality=50),
+                dict(width=50),
+            ]
+        )
+        self.assertEqual(len({info["uid"] for info in infos}), 4)
+        self.assertFalse(any(info.get("alias") for info in storage.values()))
+
+    def test_alias_of_deleted_scale(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        target, alias = storage.pre_scale_many([dict(width=100), dict(width=200)])
+        alias_uid = storage.hash_key(width=200)
+        del storage[target["uid"]]
+        self.assertIsNone(storage.get_data(alias_uid))
+        # The alias is replaced by a new scale.
+        info = storage.pre_scale(width=200)
+        self.assertEqual(info["uid"], alias_uid)
+        self.assertIsNone(info.get("alias"))
+        self.assertEqual(storage.get_or_generate(alias_uid)["data"], "some data")
+
+    def test_pre_scale_variants(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        info = storage.pre_scale_variants(("avif", "webp"), width=50)
+        self.assertEqual(len(storage), 3)
+        self.assertEqual(info["mimetype"], "image/jpeg")
+        self.assertEqual(list(info["variants"]), ["image/avif", "image/webp"])
+        webp = storage[info["variants"]["image/webp"]]
+        self.assertEqual(
+            storage.unhash(webp["key"]), dict(width=50, output_format="webp")
+        )
+        self.assertEqual(storage.get_or_generate(webp["uid"])["data"], "some data")
+        # Nothing changes the second time.
+        self.assertEqual(storage.pre_scale_variants(("avif", "webp"), width=50), info)
+        self.assertEqual(len(storage), 3)
+
+    def test_negotiate(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        info = storage.pre_scale_variants(("avif", "webp"), width=50)
+        variants = info["variants"]
+
+        def negotiate(accept):
+            return storage.negotiate(info, accept)["uid"]
+
+        self.assertEqual(negotiate(None), info["uid"])
+        self.assertEqual(negotiate("*/*"), info["uid"])
+        self.assertEqual(negotiate("image/*, */*;q=0.8"), info["uid"])
+        self.assertEqual(
+            negotiate("image/avif,image/webp,image/apng,image/*,*/*;q=0.8"),
+            variants["image/avif"],
+        )
+        self.assertEqual(negotiate("image/webp,*/*"), variants["image/webp"])
+        self.assertEqual(
+            negotiate("image/avif;q=0.5, image/webp;q=0.9"), variants["image/webp"]
+        )
+        self.assertEqual(negotiate("image/avif;q=0.5, image/jpeg"), info["uid"])
+        self.assertEqual(negotiate("image/avif;q=0, image/webp;q=x"), info["uid"])
+        # Without variants.
+        other = storage.pre_scale(width=30)
+        self.assertIs(storage.negotiate(other, "image/webp"), other)
+
+    def test_negotiate_after_generation(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        info = storage.pre_scale_variants(("avif", "webp"), width=50)
+        generated = storage.get_or_generate(info["uid"])
+        self.assertEqual(generated["data"], "some data")
+        self.assertEqual(generated["variants"], info["variants"])
+        self.assertEqual(
+            storage.negotiate(storage[info["uid"]], "image/webp")["uid"],
+            info["variants"]["image/webp"],
+        )
+
+    def test_negotiate_signed(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.signing_key = b"secret"
+        info = storage.pre_scale_variants(("webp",), width=50)
+        self.assertEqual(len(storage), 0)
+        # Only the returned info knows the variants.
+        webp = storage.negotiate(info, "image/webp")
+        self.assertEqual(webp["uid"], info["variants"]["image/webp"])
+
+    def test_pre_scale_many_non_existing_field(self):
+        self._provide_dummy_scale_adapter(None)
+        storage = self.storage
+        infos = storage.pre_scale_many([dict(width=50), dict(width=80)])
+        self.assertEqual(infos, [None, None])
+        self.assertEqual(len(storage), 0)
+
     def test_get_or_generate(self):
         self._provide_dummy_scale_adapter()
         storage = self.storage
@@ -198,6 +363,330 @@ class AnnotationStorageTests(TestCase):
         real = storage.get_or_generate(uid)
         self.assertEqual(real["uid"], uid)
 
+    def test_signed_pre_scale_does_not_write(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.signing_key = "secret"
+        scale = storage.pre_scale(fieldname="image", width=50, height=80)
+        uid = scale["uid"]
+        self.assertTrue(uid.startswith("image-50-"))
+        self.assertEqual(scale["width"], 50)
+        self.assertEqual(scale["height"], 33)
+        self.assertIsNone(scale["data"])
+        self.assertEqual(len(storage), 0)
+        # The uid is stable.
+        self.assertEqual(
+            storage.pre_scale(fieldname="image", width=50, height=80)["uid"], uid
+        )
+        self.assertEqual(
+            storage.parameters_from_uid(uid),
+            dict(fieldname="image", width=50, height=80),
+        )
+        # The parameters are reconstructed from the uid.
+        real = storage.get_or_generate(uid)
+        self.assertEqual(real["uid"], uid)
+        self.assertEqual(real["data"], "some data")
+        self.assertEqual(len(storage), 1)
+        # Now pre_scale finds the generated scale.
+        self.assertIs(storage.pre_scale(fieldname="image", width=50, height=80), real)
+
+    def test_signed_pre_scale_creates_no_annotation(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.signing_key = b"secret"
+        storage.pre_scale_many([dict(width=50), dict(width=80)])
+        storage.pre_scale_variants(("webp",), width=30)
+        self.assertNotIn("plone.scale", IAnnotations(storage.context))
+        self.assertEqual(len(storage), 0)
+        # Generating the scale creates the storage.
+        storage.get_or_generate(storage.pre_scale(width=50)["uid"])
+        self.assertIn("plone.scale", IAnnotations(storage.context))
+
+    def test_signed_uid_tampered(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.signing_key = b"secret"
+        uid = storage.pre_scale(width=50, height=80)["uid"]
+        prefix, signature, payload = uid.rsplit("-", 2)
+        self.assertIsNone(storage.get_or_generate(f"{prefix}-{signature}-{payload}a"))
+        self.assertIsNone(storage.get_or_generate(f"{prefix}-{'0' * 32}-{payload}"))
+        self.assertIsNone(storage.get_or_generate("image-50-\xe9-\xe9"))
+        storage.signing_key = "other"
+        self.assertIsNone(storage.get_or_generate(uid))
+        storage.signing_key = None
+        self.assertIsNone(storage.get_or_generate(uid))
+        self.assertEqual(len(storage), 0)
+
+    def test_get_or_generate_single_flight(self):
+        from plone.scale.singleflight import SingleFlight
+
+        release = threading.Event()
+        calls = []
+        factory = self.factory
+
+        def slow_factory():
+            calls.append(1)
+            release.wait()
+            return factory()
+
+        self.factory = slow_factory
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.single_flight = SingleFlight()
+        uid = storage.pre_scale(width=50, height=80)["uid"]
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(storage.get_or_generate(uid))
+            )
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 3)
+        self.assertEqual([result["uid"] for result in results], [uid] * 3)
+        self.assertEqual([result["data"] for result in results], ["some data"] * 3)
+        # Only the generating thread gets the stored info.  The others get
+        # the data as bytes instead of the persistent data of its connection.
+        stored = [result for result in results if result is storage[uid]]
+        self.assertEqual(len(stored), 1)
+        for result in results:
+            if result is not stored[0]:
+                self.assertEqual(dict.get(result, "data"), "some data")
+
+    def test_pre_scale_queues_after_commit(self):
+        from plone.scale.background import ScaleQueue
+
+        import transaction
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.queue = ScaleQueue(runner=storage.process_job)
+        transaction.begin()
+        low = storage.pre_scale(width=50, priority=20)
+        high = storage.pre_scale(width=30, priority=0)
+        self.assertEqual(len(storage.queue), 0)
+        transaction.commit()
+        self.assertEqual(len(storage.queue), 2)
+        storage.queue.start()
+        storage.queue.join()
+        storage.queue.stop()
+        self.assertEqual(storage[low["uid"]]["data"], "some data")
+        self.assertEqual(storage[high["uid"]]["data"], "some data")
+        # Existing scales are not queued again.
+        storage.pre_scale(width=50, priority=20)
+        transaction.commit()
+        self.assertEqual(len(storage.queue), 0)
+
+    def test_pre_scale_not_queued_on_abort(self):
+        from plone.scale.background import ScaleQueue
+
+        import transaction
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.queue = ScaleQueue(runner=storage.process_job)
+        transaction.begin()
+        storage.pre_scale(width=50)
+        transaction.abort()
+        self.assertEqual(len(storage.queue), 0)
+
+    def test_scale_stale_while_revalidate(self):
+        from plone.scale.background import ScaleQueue
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.queue = ScaleQueue(runner=storage.process_job)
+        storage.max_staleness = 1000
+        old = storage.scale(width=50)
+        # Without a change, nothing is queued.
+        self.assertIs(storage.scale(width=50), old)
+        self.assertEqual(len(storage.queue), 0)
+        # Within the maximum staleness, we get the outdated scale.
+        storage.modified = lambda: 1042
+        self.assertIs(storage.scale(width=50), old)
+        self.assertEqual(len(storage.queue), 1)
+        self.assertEqual(len(storage), 1)
+        storage.queue.start()
+        storage.queue.join()
+        storage.queue.stop()
+        self.assertEqual(len(storage), 2)
+        new = storage.scale(width=50)
+        self.assertIsNot(new, old)
+        self.assertEqual(new["modified"], 1042)
+        # Too old: regenerate inline.
+        storage.modified = lambda: 3000
+        newest = storage.scale(width=50)
+        self.assertEqual(newest["modified"], 3000)
+        self.assertEqual(len(storage.queue), 0)
+
+    def test_scale_stale_non_canonical(self):
+        from plone.scale.background import ScaleQueue
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.queue = ScaleQueue(runner=storage.process_job)
+        storage.max_staleness = 1000
+        for modified, parameters in enumerate(
+            (
+                dict(width=50, height=65536),
+                dict(width=60, mode="scale"),
+                dict(width=70, direction="down"),
+            ),
+            start=43,
+        ):
+            old = storage.scale(**parameters)
+            storage.modified = lambda modified=modified: modified
+            self.assertIs(storage.scale(**parameters), old)
+            self.assertEqual(len(storage.queue), 1)
+            storage.queue.start()
+            storage.queue.join()
+            storage.queue.stop()
+
+    def test_scale_stale_without_queue(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.max_staleness = 1000
+        old = storage.scale(width=50)
+        storage.modified = lambda: 43
+        self.assertIsNot(storage.scale(width=50), old)
+
+    def test_scale_keyed_on_version(self):
+        versions = ["digest-1"]
+        self._provide_dummy_scale_adapter(version=lambda: versions[-1])
+        storage = self.storage
+        self.assertEqual(storage.original_version(), "digest-1")
+        placeholder = storage.pre_scale(width=50)
+        self.assertEqual(placeholder["version"], "digest-1")
+        scale = storage.scale(width=50)
+        self.assertEqual(scale["uid"], placeholder["uid"])
+        self.assertEqual(scale["version"], "digest-1")
+        # Modifying the content item does not invalidate the scale.
+        storage.modified = lambda: 42 + 2 * 24 * 60 * 60 * 1000
+        self.assertEqual(storage.pre_scale(width=50)["uid"], scale["uid"])
+        self.assertIs(storage.scale(width=50), scale)
+        # Also not after the cleanup of old scales.
+        storage.scale(width=80)
+        self.assertIn(scale["uid"], storage)
+        # A new version of the image does.
+        versions.append("digest-2")
+        storage.modified = lambda: 42 + 3 * 24 * 60 * 60 * 1000
+        new_scale = storage.scale(width=50)
+        self.assertNotEqual(new_scale["uid"], scale["uid"])
+        self.assertEqual(new_scale["version"], "digest-2")
+
+    def test_original_version_asked_once(self):
+        calls = []
+
+        def version():
+            calls.append(1)
+            return "digest-1"
+
+        self._provide_dummy_scale_adapter(version=version)
+        storage = self.storage
+        storage.pre_scale_many([dict(width=width) for width in (10, 20, 30)])
+        storage.scale(width=20)
+        self.assertEqual(len(calls), 1)
+        # A modification may have changed the image.
+        storage.modified = lambda: 43
+        storage.pre_scale(width=10)
+        self.assertEqual(len(calls), 2)
+
+    def test_scale_without_version(self):
+        self._provide_dummy_scale_adapter(version=None)
+        storage = self.storage
+        scale = storage.scale(width=50)
+        self.assertNotIn("version", scale)
+        storage.modified = lambda: 43
+        self.assertNotEqual(storage.scale(width=50)["uid"], scale["uid"])
+
+    def test_get_data(self):
+        from plone.scale.bytecache import ScaleDataCache
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        self.assertIsNone(storage.get_data("unknown"))
+        uid = storage.pre_scale(width=50)["uid"]
+        self.assertIsNone(storage.get_data(uid))
+        storage.get_or_generate(uid)
+        self.assertEqual(storage.get_data(uid), "some data")
+
+        storage.data_cache = cache = ScaleDataCache()
+        self.assertEqual(storage.get_data(uid), "some data")
+        self.assertEqual(storage.get_data(uid), "some data")
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        # Regenerating invalidates the cached data.
+        storage.generate_scale(uid=uid, width=50)
+        self.assertEqual(len(cache), 0)
+        storage.get_data(uid)
+        del storage[uid]
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(storage.get_data(uid))
+        other = storage.scale(width=80)["uid"]
+        storage.get_data(other)
+        storage.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_get_or_generate_cached_data(self):
+        from plone.scale.bytecache import ScaleDataCache
+        from plone.scale.storage import ScaleData
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.data_cache = cache = ScaleDataCache()
+        uid = storage.pre_scale(width=50)["uid"]
+        storage.get_or_generate(uid)
+        # The first hit fills the cache, the next ones use it.
+        self.assertIs(storage.get_or_generate(uid), storage[uid])
+        self.assertEqual(len(cache), 1)
+        info = storage.get_or_generate(uid)
+        self.assertIsNot(info, storage[uid])
+        self.assertEqual(info["data"], "some data")
+        self.assertEqual(dict.get(info, "data"), "some data")
+        self.assertIsInstance(dict.get(storage[uid], "data"), ScaleData)
+        self.assertEqual(cache.hits, 1)
+        # scale uses the cached data too.
+        self.assertEqual(dict.get(storage.scale(width=50), "data"), "some data")
+
+    def test_metrics(self):
+        from plone.scale.metrics import PrometheusSink
+        from plone.scale.metrics import set_sink
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        sink = PrometheusSink()
+        set_sink(sink)
+        self.addCleanup(set_sink, None)
+        uid = storage.pre_scale(width=50)["uid"]
+        storage.pre_scale(width=50)
+        storage.get_or_generate(uid)
+        storage.get_or_generate(uid)
+        storage.get_or_generate("unknown")
+        storage.scale(width=80)
+        storage.scale(width=80)
+        self.assertEqual(sink.counter("pre_scale", result="new"), 1)
+        self.assertEqual(sink.counter("pre_scale", result="reused"), 1)
+        self.assertEqual(sink.counter("get_or_generate", result="generated"), 1)
+        self.assertEqual(sink.counter("get_or_generate", result="hit"), 1)
+        self.assertEqual(sink.counter("get_or_generate", result="not_found"), 1)
+        self.assertEqual(sink.counter("scale", result="miss"), 1)
+        self.assertEqual(sink.counter("scale", result="hit"), 1)
+        self.assertEqual(sink.histogram_count("generate"), 2)
+        self.assertEqual(sink.histogram_count("pre_scale"), 2)
+        self.assertEqual(sink.histogram_count("get_or_generate"), 3)
+        self.assertEqual(sink.histogram_count("scale"), 2)
+        self.assertEqual(sink.histogram_count("cleanup"), 2)
+        storage.modified = lambda: 42 + 2 * 24 * 60 * 60 * 1000
+        storage.scale(width=100)
+        self.assertEqual(sink.counter("cleanup_deleted"), 2)
+
     def testScaleForExistingScale(self):
         self._provide_dummy_scale_adapter()
         storage = self.storage
@@ -230,6 +719,107 @@ class AnnotationStorageTests(TestCase):
         ]
         self.assertEqual(uid1, uid2)
 
+    def test_canonical_parameters_same_uid(self):
+        storage = self.storage
+        uid = storage.hash_key(fieldname="image", width=50, height=50, mode="contain")
+        for parameters in (
+            dict(mode="down"),
+            dict(mode="scale-crop-to-fit"),
+            dict(direction="down"),
+            dict(direction="down", mode="cover"),
+        ):
+            self.assertEqual(
+                storage.hash_key(fieldname="image", width=50, height=50, **parameters),
+                uid,
+                parameters,
+            )
+        uid = storage.hash_key(fieldname="image", width=50)
+        for parameters in (
+            dict(mode="scale"),
+            dict(mode="thumbnail"),
+            dict(mode=None),
+            dict(height=None),
+            dict(height=0),
+            dict(height=65000),
+            dict(height=65536),
+        ):
+            self.assertEqual(
+                storage.hash_key(fieldname="image", width=50, **parameters),
+                uid,
+                parameters,
+            )
+        uid = storage.hash_key(fieldname="image", height=50)
+        self.assertEqual(storage.hash_key(fieldname="image", height=50, width=0), uid)
+        self.assertEqual(
+            storage.hash_key(fieldname="image", height=50, width=None), uid
+        )
+        self.assertNotEqual(
+            storage.hash_key(fieldname="image", height=50, width=1), uid
+        )
+        self.assertNotEqual(
+            storage.hash_key(fieldname="image", height=50, mode="cover"), uid
+        )
+
+    def test_scale_canonical_parameters(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        scale = storage.scale(width=50, height=65536, mode="down")
+        # The key has the parameters as given, which are passed to the factory
+        # when the scale is generated again.  It may scale SVG differently.
+        self.assertEqual(
+            storage.unhash(scale["key"]), dict(width=50, height=65536, mode="down")
+        )
+        self.assertIs(storage.scale(width=50, mode="contain"), scale)
+        self.assertIs(storage.pre_scale(width=50, direction="down"), scale)
+        self.assertEqual(len(storage), 1)
+
+    def test_get_or_generate_passes_parameters_as_given(self):
+        from plone.scale.interfaces import IImageScaleFactory
+        from zope.component import adapter
+
+        calls = []
+
+        @implementer(IImageScaleFactory)
+        @adapter(_DummyContext)
+        class RecordingISF:
+            def __init__(self, context):
+                self.context = context
+
+            def __call__(self, **parameters):
+                calls.append(parameters)
+                return "some data", "svg+xml", (100, 100)
+
+            def get_original_value(self, fieldname=None):
+                return DummyImage()
+
+        provideAdapter(RecordingISF)
+        storage = self.storage
+        uid = storage.pre_scale(width=100, height=65536, mode="contain")["uid"]
+        storage.get_or_generate(uid)
+        self.assertEqual(calls, [dict(width=100, height=65536, mode="contain")])
+
+    def test_scale_legacy_uid(self):
+        # Scales stored before the parameters were made canonical are found.
+        from plone.scale.storage import ScaleInfo
+
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        parameters = dict(width=50, height=65536, mode="scale")
+        uid = storage._hash_key(dict(parameters))
+        self.assertNotEqual(uid, storage.hash_key(**parameters))
+        info = ScaleInfo(
+            uid=uid,
+            key=storage.hash(**parameters),
+            modified=42,
+            data="old data",
+            width=50,
+            height=33,
+        )
+        storage.storage[uid] = info
+        self.assertIs(storage.scale(**parameters), info)
+        self.assertIs(storage.pre_scale(**parameters), info)
+        self.assertEqual(len(storage), 1)
+
     def test_scale_without_height_width(self):
         # Ensures that the scale will only be removed from the hash key
         # if we have width and height.
@@ -402,6 +992,160 @@ class AnnotationStorageTests(TestCase):
         del storage[scale_leadimage_new["uid"]]
         self.assertEqual(len(storage), 0)
 
+    def test_cache_modified_time(self):
+        storage = self.storage
+        calls = []
+
+        def modified():
+            calls.append(1)
+            return 42
+
+        storage.modified = modified
+        storage.modified_time
+        storage.modified_time
+        self.assertEqual(len(calls), 2)
+
+        storage.cache = True
+        storage.modified_time
+        storage.modified_time
+        self.assertEqual(len(calls), 3)
+        # Replacing the callable is noticed.
+        storage.modified = lambda: 43
+        self.assertEqual(storage.modified_time, 43)
+
+    def test_cache_storage_lookup(self):
+        from plone.scale.storage import AnnotationStorage
+
+        provideAdapter(zope.annotation.attribute.AttributeAnnotations)
+        context = _DummyContext()
+        storage = AnnotationStorage(context, cache=True)
+        scales = storage.storage
+        self.assertIs(storage.storage, scales)
+        # Replace the annotation behind our back.
+        del context.__annotations__["plone.scale"]
+        self.assertIs(storage.storage, scales)
+        storage.invalidate_cache()
+        self.assertIsNot(storage.storage, scales)
+
+    def test_cache_per_transaction(self):
+        import transaction
+
+        storage = self.storage
+        storage.cache = True
+        values = iter([1, 2])
+        storage.modified = lambda: next(values)
+        self.assertEqual(storage.modified_time, 1)
+        self.assertEqual(storage.modified_time, 1)
+        transaction.abort()
+        self.assertEqual(storage.modified_time, 2)
+
+    def test_cache_invalidated_on_write(self):
+        self._provide_dummy_scale_adapter()
+        storage = self.storage
+        storage.cache = True
+        values = itertools.count(42)
+        storage.modified = lambda: next(values)
+        self.assertEqual(storage.modified_time, 42)
+        self.assertEqual(storage.modified_time, 42)
+        storage.scale(foo=23, bar=42)
+        self.assertGreater(storage.modified_time, 42)
+
+    def test_scale_info(self):
+        from plone.scale.storage import has_data
+        from plone.scale.storage import ScaleData
+        from plone.scale.storage import ScaleInfo
+
+        info = ScaleInfo(uid="uid", data=ScaleData(b"data"))
+        self.assertEqual(info["data"], b"data")
+        self.assertEqual(info.get("data"), b"data")
+        self.assertEqual(info.get("uid"), "uid")
+        self.assertIsNone(info.get("width"))
+        self.assertTrue(has_data(info))
+        self.assertFalse(has_data(ScaleInfo(data=None)))
+        # Unpacking gives the data as well, like plone.namedfile does.
+        self.assertEqual((lambda **kw: kw)(**info)["data"], b"data")
+        self.assertEqual(dict(info)["data"], b"data")
+        self.assertIn(("data", b"data"), info.items())
+        self.assertIn(b"data", info.values())
+        # Copying and pickling keep the data stored separately.
+        self.assertIsInstance(dict.get(info.copy(), "data"), ScaleData)
+        self.assertEqual(info.copy()["data"], b"data")
+        copied = pickle.loads(pickle.dumps(info))
+        self.assertIsInstance(copied, ScaleInfo)
+        self.assertIsInstance(dict.get(copied, "data"), ScaleData)
+        # Infos stored by older versions are plain dicts.
+        self.assertTrue(has_data(dict(data=b"data")))
+
+    def test_data_loaded_lazily(self):
+        from plone.scale.storage import AnnotationStorage
+        from plone.scale.storage import ScaleData
+
+        import transaction
+        import ZODB
+
+        self._provide_dummy_scale_adapter()
+        provideAdapter(zope.annotation.attribute.AttributeAnnotations)
+        db = ZODB.DB(None)
+        self.addCleanup(db.close)
+        connection = db.open()
+        connection.root()["context"] = _PersistentContext()
+        storage = AnnotationStorage(connection.root()["context"], lambda: 42)
+        uid = storage.scale(width=10)["uid"]
+        transaction.commit()
+        # Turn all objects into ghosts, like after a restart.
+        connection.cacheMinimize()
+        connection.close()
+
+        connection = db.open()
+        self.addCleanup(connection.close)
+        self.addCleanup(transaction.abort)
+        storage = AnnotationStorage(connection.root()["context"], lambda: 42)
+        info = storage[uid]
+        data = dict.get(info, "data")
+        self.assertIsInstance(data, ScaleData)
+        # Looking up the scale does not load its data.
+        self.assertEqual(storage.pre_scale(width=10)["uid"], uid)
+        self.assertEqual(storage.scale(width=10)["uid"], uid)
+        self.assertIsNone(data._p_changed)
+        self.assertEqual(info["data"], "some data")
+        self.assertFalse(data._p_changed)
+
+    def test_variants_survive_conflict(self):
+        from plone.scale.storage import AnnotationStorage
+        from ZODB.FileStorage import FileStorage
+
+        import tempfile
+        import transaction
+        import ZODB
+
+        self._provide_dummy_scale_adapter()
+        provideAdapter(zope.annotation.attribute.AttributeAnnotations)
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        db = ZODB.DB(FileStorage(f"{tempdir.name}/Data.fs"))
+        self.addCleanup(db.close)
+        with db.transaction() as connection:
+            connection.root()["context"] = context = _PersistentContext()
+            uid = AnnotationStorage(context, lambda: 42).pre_scale(width=50)["uid"]
+
+        # Two requests change the scales at the same time.
+        first = transaction.TransactionManager()
+        second = transaction.TransactionManager()
+        connection = db.open(first)
+        self.addCleanup(connection.close)
+        storage = AnnotationStorage(connection.root()["context"], lambda: 42)
+        variants = storage.pre_scale_variants(("webp",), width=50)["variants"]
+        connection = db.open(second)
+        self.addCleanup(connection.close)
+        AnnotationStorage(connection.root()["context"], lambda: 42).pre_scale(width=80)
+        second.commit()
+        first.commit()
+
+        with db.transaction() as connection:
+            storage = AnnotationStorage(connection.root()["context"], lambda: 42)
+            self.assertEqual(storage[uid]["variants"], variants)
+            self.assertEqual(len(storage), 3)
+
     def testClear(self):
         self._provide_dummy_scale_adapter()
         storage = self.storage
@@ -411,6 +1155,87 @@ class AnnotationStorageTests(TestCase):
         self.assertEqual(len(storage), 0)
 
 
+class ScalesDictTests(TestCase):
+    def _resolve(self, old, saved, new):
+        from plone.scale.storage import ScalesDict
+
+        return ScalesDict()._p_resolveConflict(
+            dict(data=old), dict(data=saved), dict(data=new)
+        )["data"]
+
+    def _info(self, key=(("width", 50),), modified=42, data=None):
+        return dict(key=key, modified=modified, data=data)
+
+    def test_resolve_different_additions(self):
+        one = self._info(key=(("width", 10),))
+        two = self._info(key=(("width", 20),))
+        resolved = self._resolve({}, dict(one=one), dict(two=two))
+        self.assertEqual(resolved, dict(one=one, two=two))
+
+    def test_resolve_identical_placeholders(self):
+        saved = self._info(modified=1000)
+        new = self._info(modified=1001)
+        resolved = self._resolve({}, dict(uid=saved), dict(uid=new))
+        self.assertIs(resolved["uid"], saved)
+
+    def test_resolve_placeholder_and_generated(self):
+        placeholder = self._info(modified=1000)
+        generated = self._info(data="data")
+        resolved = self._resolve({}, dict(uid=placeholder), dict(uid=generated))
+        self.assertIs(resolved["uid"], generated)
+        resolved = self._resolve({}, dict(uid=generated), dict(uid=placeholder))
+        self.assertIs(resolved["uid"], generated)
+
+    def test_resolve_both_generated_from_placeholder(self):
+        placeholder = self._info(modified=1000)
+        saved = self._info(data="saved")
+        new = self._info(data="new")
+        resolved = self._resolve(dict(uid=placeholder), dict(uid=saved), dict(uid=new))
+        self.assertIs(resolved["uid"], saved)
+
+    def test_resolve_variants_and_generated(self):
+        placeholder = self._info(modified=1000)
+        with_variants = dict(placeholder, variants=dict(webp="variant"))
+        generated = self._info(data="data")
+        resolved = self._resolve(
+            dict(uid=placeholder), dict(uid=generated), dict(uid=with_variants)
+        )
+        self.assertEqual(
+            resolved["uid"], dict(generated, variants=dict(webp="variant"))
+        )
+
+    def test_resolve_metrics(self):
+        from plone.scale.metrics import PrometheusSink
+        from plone.scale.metrics import set_sink
+        from ZODB.POSException import ConflictError
+
+        sink = PrometheusSink()
+        set_sink(sink)
+        self.addCleanup(set_sink, None)
+        self._resolve({}, dict(uid=self._info()), dict(uid=self._info()))
+        self.assertEqual(sink.counter("conflict", result="resolved"), 1)
+        saved = self._info(key=(("width", 10),))
+        self.assertRaises(
+            ConflictError, self._resolve, {}, dict(uid=saved), dict(uid=self._info())
+        )
+        self.assertEqual(sink.counter("conflict", result="raised"), 1)
+        self.assertEqual(sink.histogram_count("conflict"), 2)
+
+    def test_resolve_conflicting_additions(self):
+        from ZODB.POSException import ConflictError
+
+        saved = self._info(key=(("width", 10),))
+        new = self._info(key=(("width", 20),))
+        self.assertRaises(
+            ConflictError, self._resolve, {}, dict(uid=saved), dict(uid=new)
+        )
+        saved = self._info(modified=42, data="saved")
+        new = self._info(modified=43, data="new")
+        self.assertRaises(
+            ConflictError, self._resolve, {}, dict(uid=saved), dict(uid=new)
+        )
+
+
 def test_suite():
     from unittest import defaultTestLoader
 